@@ -0,0 +1,127 @@
+import asyncio
+import concurrent.futures
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTClient:
+    """
+    asyncio counterpart of the TClient. Requests are executed by the wrapped TClient on a thread pool, so they share
+    its keep-alive connection pool, timeouts and retries, while up to `max_in_flight` requests are in flight at once.
+
+    The sending methods have the same signature as the TClient's methods, so they can be called from the (synchronous)
+    handlers of the CountdownBot. Instead of blocking, they schedule the request and return an asyncio.Task, which may
+    be awaited to get the API result. Requests to the same chat are sent in order of their scheduling.
+    """
+    def __init__(self, tclient, max_in_flight=10):
+        """
+        :param tclient: The synchronous Telegram client used to execute the requests
+        :type tclient: tclient.TClient
+        :param max_in_flight: Maximum number of concurrent outbound requests
+        :type max_in_flight: int
+        """
+        self.tclient = tclient
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='tclient-send')
+        # getUpdates blocks for the long polling timeout, so it gets its own thread to not take a sending slot
+        self._poll_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tclient-poll')
+        self._chat_tails = {}
+        self._pending = set()
+
+    def __str__(self):
+        return "{} requests in flight; {}".format(self.pending, self.tclient)
+
+    @property
+    def stats(self):
+        return self.tclient.stats
+
+    @property
+    def pending(self):
+        """
+        Number of scheduled requests which are not finished yet
+        """
+        return len(self._pending)
+
+    @property
+    def depth(self):
+        """
+        Number of requests waiting to be sent or in flight, like SendQueue.depth (used to hold back catch-ups)
+        """
+        return len(self._pending)
+
+    async def get_updates(self, timeout):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._poll_executor, self.tclient.get_updates, timeout)
+
+    def set_update_offset(self, offset):
+        self.tclient.set_update_offset(offset)
+
+    def send_message(self, text, chat_id, reply_markup=None, parse_mode="HTML"):
+        return self._submit(chat_id, self.tclient.send_message, text, chat_id, reply_markup, parse_mode)
+
+    def send_sticker(self, sticker, chat_id):
+        return self._submit(chat_id, self.tclient.send_sticker, sticker, chat_id)
+
+    def edit_message_text(self, text, chat_id, message_id, reply_markup=None, parse_mode="HTML"):
+        return self._submit(chat_id, self.tclient.edit_message_text, text, chat_id, message_id, reply_markup,
+                            parse_mode)
+
+    def delete_message(self, chat_id, message_id):
+        return self._submit(chat_id, self.tclient.delete_message, chat_id, message_id)
+
+    def pin_chat_message(self, chat_id, message_id, disable_notification=True):
+        return self._submit(chat_id, self.tclient.pin_chat_message, chat_id, message_id, disable_notification)
+
+    def download_file(self, file_id, max_size=1024 * 1024):
+        return self._submit(('file', file_id), self.tclient.download_file, file_id, max_size)
+
+    def answer_inline_query(self, inline_query_id, results, cache_time=300, is_personal=False):
+        return self._submit(('inline_query', inline_query_id), self.tclient.answer_inline_query, inline_query_id,
+                            results, cache_time, is_personal)
+
+    async def drain(self):
+        """
+        Wait until all scheduled requests are finished.
+        """
+        while self._pending:
+            await asyncio.wait(list(self._pending))
+
+    async def close(self):
+        await self.drain()
+        self._executor.shutdown()
+        self._poll_executor.shutdown(wait=False)
+        self.tclient.close()
+
+    def _submit(self, chat_id, function, *args):
+        """
+        Schedule a call of the given TClient method on the thread pool after all previously scheduled requests to the
+        same chat.
+
+        :return: The asyncio Task of the request
+        :rtype: asyncio.Task
+        """
+        task = asyncio.ensure_future(self._call_after(self._chat_tails.get(chat_id), function, *args))
+        self._chat_tails[chat_id] = task
+        self._pending.add(task)
+        task.add_done_callback(functools.partial(self._on_done, chat_id))
+        return task
+
+    async def _call_after(self, previous, function, *args):
+        if previous is not None:
+            # Only wait for the previous request. Its errors are reported by its own done callback.
+            await asyncio.wait([previous])
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(self._executor, functools.partial(function, *args))
+        # A client with a send queue only enqueues the request and returns a future of the result
+        if isinstance(result, concurrent.futures.Future):
+            result = await asyncio.wrap_future(result)
+        return result
+
+    def _on_done(self, chat_id, task):
+        self._pending.discard(task)
+        if self._chat_tails.get(chat_id) is task:
+            del self._chat_tails[chat_id]
+        if not task.cancelled() and task.exception():
+            logger.error("Error while sending request to Telegram API:", exc_info=task.exception())
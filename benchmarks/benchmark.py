@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmarks of the CountdownBot against the fake Telegram API.
+
+Measures the update throughput through the bot's dispatching, the latency from receiving a command until its reply
+arrives at the API, the wall time to send a subscription fan-out and its scaling with the number of shard processes
+(see --shards of countdownBot.py). The results are compared to a stored baseline to detect regressions; use
+--save-baseline to store new baseline results.
+"""
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from countdownBot import CountdownBot  # noqa: E402
+from dbhelper import DBHelper  # noqa: E402
+from sendqueue import SendQueue  # noqa: E402
+from tclient import TClient  # noqa: E402
+from fake_telegram import FakeTelegramAPI  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Metric name -> True if higher values are better. Metrics not listed here (like the sharded fan-out times per number
+# of shards) are better if lower.
+METRICS = {
+    'dispatch_updates_per_s': True,
+    'reply_latency_p50_ms': False,
+    'reply_latency_p99_ms': False,
+    'fanout_seconds': False,
+    'fanout_messages_per_s': True,
+}
+
+
+class BenchmarkBot:
+    """
+    A CountdownBot with a fresh temporary database, connected to a fake Telegram API
+    """
+    def __init__(self, api_url, args, subscriptions=0, database=None):
+        """
+        :param database: Path of an existing database to use instead of a fresh one
+        """
+        self.directory = None
+        if database is None:
+            self.directory = tempfile.TemporaryDirectory()
+            database = os.path.join(self.directory.name, 'benchmark.sqlite')
+            create_database(database, args, subscriptions)
+        self.db = DBHelper(database)
+
+        self.tclient = SendQueue(TClient('benchmark', pool_size=args.send_workers, base_url=api_url),
+                                 workers=args.send_workers, global_rate=args.rate, chat_rate=args.rate,
+                                 chat_burst=args.rate, group_rate=args.rate, group_burst=args.rate)
+        self.bot = CountdownBot(self.db, self.tclient, [1], datetime.timedelta(0), args.workers)
+
+    def close(self):
+        self.bot.stop()
+        self.tclient.close()
+        if self.directory:
+            self.directory.cleanup()
+
+
+def create_database(path, args, subscriptions):
+    db = DBHelper(path)
+    db.setup()
+    today = datetime.date.today()
+    for i in range(args.akademien):
+        db.add_akademie('Akademie {}'.format(i), 'Beschreibung {}'.format(i),
+                        (today + datetime.timedelta(days=10 + i)).strftime('%Y-%m-%d'))
+    with db.c:
+        db.c.executemany("INSERT INTO subscribers (chatID, subscriptions, time) VALUES (?, '1', '06:00:00')",
+                         ((chat_id,) for chat_id in range(1, subscriptions + 1)))
+    db.c.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def bench_dispatch(api, args):
+    """
+    Process `args.updates` commands from `args.chats` private chats.
+
+    :return: Update throughput and the latency from submitting an update until its reply was received by the API
+    """
+    commands = ['/countdown', '/list', '/now', '/help']
+    updates = [{'update_id': i,
+                'message': {'message_id': i, 'text': commands[i % len(commands)],
+                            'chat': {'id': i % args.chats + 1, 'type': 'private'},
+                            'from': {'id': i % args.chats + 1, 'first_name': 'Bench'}}}
+               for i in range(args.updates)]
+
+    api.reset()
+    b = BenchmarkBot(api.url, args)
+    try:
+        submitted = {}
+        start = time.monotonic()
+        for update in updates:
+            submitted.setdefault(update['message']['chat']['id'], []).append(time.monotonic())
+            b.bot.process_update(update)
+        if b.bot.dispatcher:
+            b.bot.dispatcher.join()
+        dispatch_time = time.monotonic() - start
+        if not api.wait_for(len(updates), timeout=args.timeout):
+            raise RuntimeError("Not all replies have been received")
+    finally:
+        b.close()
+
+    # Each command is answered by exactly one message and messages to a chat are sent in order
+    received = {}
+    for r in api.sent('sendMessage'):
+        received.setdefault(int(r.params['chat_id']), []).append(r.time)
+    latencies = [(r - s) * 1000 for chat_id in submitted for s, r in zip(submitted[chat_id], received[chat_id])]
+    return {
+        'dispatch_updates_per_s': len(updates) / dispatch_time,
+        'reply_latency_p50_ms': percentile(latencies, 50),
+        'reply_latency_p99_ms': percentile(latencies, 99),
+    }
+
+
+def bench_fanout(api, args):
+    """
+    Send the daily countdown to `args.subscriptions` subscribers.
+
+    :return: Wall time until all messages were received by the API
+    """
+    api.reset()
+    b = BenchmarkBot(api.url, args, args.subscriptions)
+    try:
+        start = time.monotonic()
+        b.bot.send_subscriptions('1', max_age=datetime.timedelta.max)
+        if not api.wait_for(args.subscriptions, timeout=args.timeout):
+            raise RuntimeError("Not all subscriptions have been received")
+        duration = time.monotonic() - start
+    finally:
+        b.close()
+    return {
+        'fanout_seconds': duration,
+        'fanout_messages_per_s': args.subscriptions / duration,
+    }
+
+
+def _send_shard(api_url, database, args, shard, shard_count, barrier):
+    """
+    Worker process of `bench_sharded_fanout()`: Send the subscriptions of one shard.
+    """
+    b = BenchmarkBot(api_url, args, database=database)
+    try:
+        barrier.wait()
+        b.bot.send_subscriptions('1', max_age=datetime.timedelta.max, shard=(shard, shard_count))
+    finally:
+        b.close()
+
+
+def bench_sharded_fanout(api, args):
+    """
+    Send the daily countdown to `args.shard_subscriptions` subscribers, split across 1, 2, ... processes (as given by
+    `args.shards`) sharing one database. The fake API answers with `args.shard_latency`, so that the sending processes
+    and not the fake API are the bottleneck.
+
+    :return: Wall time until all messages were received by the API for each number of processes
+    """
+    results = {}
+    latency = api.latency
+    api.latency = args.shard_latency
+    context = multiprocessing.get_context('spawn')
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, 'benchmark.sqlite')
+            create_database(database, args, args.shard_subscriptions)
+            for shard_count in args.shards:
+                api.reset()
+                barrier = context.Barrier(shard_count + 1)
+                processes = [context.Process(target=_send_shard,
+                                             args=(api.url, database, args, shard, shard_count, barrier))
+                             for shard in range(shard_count)]
+                for p in processes:
+                    p.start()
+                # Start measuring when all processes have loaded the database
+                barrier.wait(args.timeout)
+                start = time.monotonic()
+                if not api.wait_for(args.shard_subscriptions, timeout=args.timeout):
+                    raise RuntimeError("Not all subscriptions have been received")
+                results['sharded_fanout_{}_seconds'.format(shard_count)] = time.monotonic() - start
+                for p in processes:
+                    p.join(args.timeout)
+    finally:
+        api.latency = latency
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the results next to the baseline.
+
+    :return: Names of the metrics, which are worse than the baseline by more than `tolerance` (relative)
+    """
+    regressions = []
+    print("{:<26} {:>12} {:>12} {:>8}".format('metric', 'result', 'baseline', 'change'))
+    for name, value in results.items():
+        higher_is_better = METRICS.get(name, False)
+        base = baseline.get(name)
+        if not base:
+            print("{:<26} {:>12.2f} {:>12} {:>8}".format(name, value, '-', '-'))
+            continue
+        change = (value - base) / base
+        regression = -change if higher_is_better else change
+        flag = ' REGRESSION' if regression > tolerance else ''
+        if flag:
+            regressions.append(name)
+        print("{:<26} {:>12.2f} {:>12.2f} {:>+7.1%}{}".format(name, value, base, change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CountdownBot end-to-end benchmarks')
+    parser.add_argument('--updates', type=int, default=2000, help="Number of updates to dispatch")
+    parser.add_argument('--chats', type=int, default=200, help="Number of chats sending the updates")
+    parser.add_argument('--subscriptions', type=int, default=5000, help="Number of subscriptions to fan out")
+    parser.add_argument('--akademien', type=int, default=20, help="Number of academies in the database")
+    parser.add_argument('--workers', type=int, default=4, help="Number of update dispatcher threads")
+    parser.add_argument('--send-workers', type=int, default=8, help="Number of send queue threads")
+    parser.add_argument('--rate', type=float, default=100000,
+                        help="Rate limit (messages per second) of the send queue. Defaults to practically unlimited.")
+    parser.add_argument('--latency', type=float, default=0.0, help="Latency (in seconds) of the fake API")
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help="Probability of 429 Too Many Requests responses of the fake API")
+    parser.add_argument('--shards', type=lambda s: [int(x) for x in s.split(',')], default=[1, 2, 4],
+                        help="Comma separated numbers of processes for the sharded fan-out. Defaults to 1,2,4")
+    parser.add_argument('--shard-subscriptions', type=int, default=2000,
+                        help="Number of subscriptions to fan out with shards")
+    parser.add_argument('--shard-latency', type=float, default=0.05,
+                        help="Latency (in seconds) of the fake API for the sharded fan-out. Defaults to 0.05")
+    parser.add_argument('--timeout', type=float, default=600, help="Maximum time (in seconds) per benchmark")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="Path of the baseline results")
+    parser.add_argument('--save-baseline', action='store_true', help="Store the results as new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Relative deviation from the baseline to report as regression. Defaults to 0.25")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s [%(levelname)-8s] %(name)s - %(message)s")
+
+    api = FakeTelegramAPI(latency=args.latency, rate_limit_probability=args.rate_limit, retry_after=0.1).start()
+    try:
+        results = {}
+        results.update(bench_dispatch(api, args))
+        results.update(bench_fanout(api, args))
+        if args.shards:
+            results.update(bench_sharded_fanout(api, args))
+    finally:
+        api.stop()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({k: round(v, 2) for k, v in results.items()}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print("Stored results as baseline in {}".format(args.baseline))
+    elif regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
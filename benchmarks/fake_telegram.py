@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Telegram Bot API, to measure the bot without hitting the real API.
+
+It serves scripted getUpdates batches, accepts sendMessage, sendSticker, editMessageText and the other methods used by
+the bot, records all requests and can inject latency and 429 "Too Many Requests" errors. Point the bot at it with
+`url = http://localhost:<port>` in the [telegram] section of config.ini.
+"""
+import argparse
+import collections
+import http.server
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+Request = collections.namedtuple('Request', ('method', 'params', 'time'))
+
+
+class FakeTelegramAPI:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, rate_limit_probability=0.0, retry_after=1,
+                 max_poll_time=1.0):
+        """
+        :param host: Address to listen on
+        :param port: Port to listen on (0 to pick a free port)
+        :param latency: Delay (in seconds) before answering each request (except getUpdates)
+        :param rate_limit_probability: Probability to answer a sending request with 429 "Too Many Requests"
+        :param retry_after: retry_after value (in seconds) of injected 429 responses
+        :param max_poll_time: Maximum time (in seconds) a getUpdates request waits for updates
+        """
+        self.latency = latency
+        self.rate_limit_probability = rate_limit_probability
+        self.retry_after = retry_after
+        self.max_poll_time = max_poll_time
+        self.requests = []
+        self.rate_limited = 0
+        self._updates = collections.deque()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._cond = threading.Condition()
+        self.httpd = http.server.ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name='fake-telegram', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def add_updates(self, updates):
+        """
+        Script updates to be returned by getUpdates. Updates without update_id get one assigned.
+
+        :type updates: [dict]
+        """
+        with self._cond:
+            for update in updates:
+                update.setdefault('update_id', next(self._update_ids))
+                self._updates.append(update)
+            self._cond.notify_all()
+
+    def sent(self, method=None):
+        """
+        :return: All recorded requests (of the given method)
+        :rtype: [Request]
+        """
+        with self._cond:
+            return [r for r in self.requests if method is None or r.method == method]
+
+    def wait_for(self, count, method='sendMessage', timeout=60):
+        """
+        Wait until `count` requests of the given method have been received.
+
+        :return: True if the requests have been received, False on timeout
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: sum(1 for r in self.requests if r.method == method) >= count, timeout)
+
+    def reset(self):
+        with self._cond:
+            self.requests = []
+            self.rate_limited = 0
+            self._updates.clear()
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset', 0))
+        timeout = min(float(params.get('timeout', 0)), self.max_poll_time)
+        with self._cond:
+            while self._updates and self._updates[0]['update_id'] < offset:
+                self._updates.popleft()
+            if not self._updates:
+                self._cond.wait(timeout)
+            return list(self._updates)
+
+    def _handle(self, method, params):
+        if method == 'getUpdates':
+            return {'ok': True, 'result': self._get_updates(params)}
+
+        if self.latency:
+            time.sleep(self.latency)
+        with self._cond:
+            if method.startswith('send') and random.random() < self.rate_limit_probability:
+                self.rate_limited += 1
+                return {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after {}'
+                        .format(self.retry_after), 'parameters': {'retry_after': self.retry_after}}
+            self.requests.append(Request(method, params, time.monotonic()))
+            self._cond.notify_all()
+
+        if method in ('sendMessage', 'sendSticker', 'editMessageText'):
+            return {'ok': True, 'result': {
+                'message_id': int(params.get('message_id') or next(self._message_ids)),
+                'chat': {'id': int(params.get('chat_id', 0))},
+                'date': int(time.time()),
+                'text': params.get('text', '')}}
+        return {'ok': True, 'result': True}
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Send headers and body of a response in one segment, so that the client's delayed ACK does not add
+            # latency (like Telegram's servers)
+            disable_nagle_algorithm = True
+            wbufsize = -1
+
+            def do_GET(self):
+                self._dispatch()
+
+            def do_POST(self):
+                self._dispatch()
+
+            def _dispatch(self):
+                url = urllib.parse.urlsplit(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                params = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length).decode('utf8')
+                    if self.headers.get('Content-Type', '').startswith('application/json'):
+                        params.update(json.loads(body))
+                    else:
+                        params.update({k: v[-1] for k, v in urllib.parse.parse_qs(body).items()})
+
+                body = json.dumps(api._handle(method, params)).encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Telegram Bot API server')
+    parser.add_argument('-p', '--port', type=int, default=8081, help="Port to listen on. Defaults to 8081")
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help="Delay (in seconds) before answering each request")
+    parser.add_argument('-r', '--rate-limit', type=float, default=0.0,
+                        help="Probability of answering a sending request with 429 Too Many Requests")
+    parser.add_argument('-u', '--updates',
+                        help="JSON file with a list of updates to be returned by getUpdates")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)-8s] %(name)s - %(message)s")
+
+    api = FakeTelegramAPI('127.0.0.1', args.port, args.latency, args.rate_limit)
+    if args.updates:
+        with open(args.updates) as f:
+            api.add_updates(json.load(f))
+    logger.info("Serving fake Telegram API at %s", api.url)
+    try:
+        api.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import csv
+import datetime
+import html
+import io
+import json
+
+# Maximum number of errors reported for an import
+MAX_ERRORS = 10
+
+
+class ImportData:
+    """
+    Validated content of an import file: academies and subscriptions as rows for the database and the errors of the
+    invalid entries. Names and descriptions are HTML-escaped, like the ones added via /add_akademie.
+    """
+    def __init__(self):
+        # (name, description, date) tuples
+        self.akademien = []
+        # (chat_id, subscriptions, time) tuples
+        self.subscriptions = []
+        self.errors = []
+
+    def __bool__(self):
+        return bool(self.akademien or self.subscriptions)
+
+    def error(self, message):
+        self.errors.append(message)
+
+
+def parse(data, filename=''):
+    """
+    Parse and validate an import file. CSV files need a header row with the columns name, description and date
+    (YYYY-MM-DD, may be empty) and contain academies only. JSON files contain a list of academies (objects with the same
+    keys) or an object with the lists 'akademien' and 'subscriptions' (objects with the keys chat_id, type and time),
+    as written by `export()`.
+
+    :param data: The content of the file
+    :type data: bytes or str
+    :param filename: Name of the file, used to detect its format. Without a .csv or .json extension, the format is
+                     guessed from the content.
+    :rtype: ImportData
+    """
+    result = ImportData()
+    if isinstance(data, bytes):
+        try:
+            data = data.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            result.error("Die Datei ist nicht UTF-8-kodiert")
+            return result
+
+    if filename.lower().endswith('.json') or (not filename.lower().endswith('.csv')
+                                              and data.lstrip()[:1] in ('[', '{')):
+        try:
+            content = json.loads(data)
+        except ValueError as e:
+            result.error("Ungültiges JSON: {}".format(e))
+            return result
+        if isinstance(content, list):
+            content = {'akademien': content}
+        if not isinstance(content, dict):
+            result.error("Erwartet wird eine Liste von Akademien oder ein Objekt mit 'akademien' und 'subscriptions'")
+            return result
+        akademien = content.get('akademien', [])
+        subscriptions = content.get('subscriptions', [])
+        first_line = 1
+    else:
+        try:
+            dialect = csv.Sniffer().sniff(data[:4096], delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        akademien = csv.DictReader(io.StringIO(data), dialect=dialect)
+        subscriptions = []
+        # Line numbers of the data rows start after the header
+        first_line = 2
+
+    names = set()
+    for line, entry in enumerate(akademien, first_line):
+        row = _validate_akademie(entry, line, result)
+        if row is None:
+            continue
+        if row[0] in names:
+            result.error("Eintrag {}: Die Akademie '{}' kommt mehrfach vor".format(line, html.unescape(row[0])))
+            continue
+        names.add(row[0])
+        result.akademien.append(row)
+
+    for line, entry in enumerate(subscriptions, first_line):
+        row = _validate_subscription(entry, line, result)
+        if row is not None:
+            result.subscriptions.append(row)
+    return result
+
+
+def export(db, out):
+    """
+    Write all academies and subscriptions as JSON document (in the format read by `parse()`). The rows are streamed
+    from the database, so the export does not hold the whole database in memory.
+
+    :type db: dbhelper.DBHelper
+    :param out: Text file to write to
+    :return: The number of exported academies and subscriptions
+    :rtype: (int, int)
+    """
+    out.write('{"akademien": [')
+    akademien = 0
+    for name, description, date in db.iter_akademien():
+        out.write('{}\n  {}'.format(',' if akademien else '', json.dumps(
+            {'name': html.unescape(name), 'description': html.unescape(description or ''), 'date': date or ''},
+            ensure_ascii=False)))
+        akademien += 1
+    out.write('\n], "subscriptions": [')
+    subscriptions = 0
+    for chat_id, subscription, time in db.iter_subscriptions():
+        out.write('{}\n  {}'.format(',' if subscriptions else '', json.dumps(
+            {'chat_id': chat_id, 'type': subscription, 'time': time})))
+        subscriptions += 1
+    out.write('\n]}\n')
+    return akademien, subscriptions
+
+
+def summary(data, added, updated):
+    """
+    Format the result of an import (as plain text).
+
+    :type data: ImportData
+    :param added: Number of new academies
+    :param updated: Number of replaced academies
+    :rtype: str
+    """
+    if data.errors:
+        lines = ['Import abgebrochen, {} fehlerhafte Einträge:'.format(len(data.errors))]
+        lines.extend(data.errors[:MAX_ERRORS])
+        if len(data.errors) > MAX_ERRORS:
+            lines.append('…')
+        return '\n'.join(lines)
+    if not data:
+        return 'Die Datei enthält keine Akademien oder Abonnements.'
+    return '{} Akademien importiert ({} neu, {} aktualisiert), {} Abonnements importiert.'.format(
+        len(data.akademien), added, updated, len(data.subscriptions))
+
+
+def _validate_akademie(entry, line, result):
+    if not isinstance(entry, dict):
+        result.error("Eintrag {}: Erwartet wird ein Objekt mit name, description und date".format(line))
+        return None
+    name = str(entry.get('name') or '').strip()
+    description = str(entry.get('description') or '').strip()
+    date = str(entry.get('date') or '').strip()
+    if not name:
+        result.error("Eintrag {}: Der Name fehlt".format(line))
+        return None
+    if date:
+        try:
+            datetime.datetime.strptime(date, '%Y-%m-%d')
+        except ValueError:
+            result.error("Eintrag {}: Ungültiges Datum '{}' (erwartet: YYYY-MM-DD)".format(line, date))
+            return None
+    return html.escape(name), html.escape(description), date
+
+
+def _validate_subscription(entry, line, result):
+    if not isinstance(entry, dict):
+        result.error("Abonnement {}: Erwartet wird ein Objekt mit chat_id, type und time".format(line))
+        return None
+    chat_id = str(entry.get('chat_id', '')).strip()
+    subscription = str(entry.get('type', '1')).strip()
+    try:
+        int(chat_id)
+        time = datetime.datetime.strptime(str(entry.get('time', '06:00:00')).strip(), '%H:%M:%S').strftime('%H:%M:%S')
+    except ValueError:
+        result.error("Abonnement {}: Ungültige chat_id oder Uhrzeit (erwartet: HH:MM:SS)".format(line))
+        return None
+    # Daily or live subscription, see countdownBot.DAILY_SUBSCRIPTION and LIVE_SUBSCRIPTION
+    if subscription not in ('1', '2'):
+        result.error("Abonnement {}: Unbekannter Typ '{}'".format(line, subscription))
+        return None
+    return chat_id, subscription, time
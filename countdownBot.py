@@ -1,19 +1,154 @@
 #!/usr/bin/env python3
 import logging
 import argparse
+import collections
+import os
+import signal
+import subprocess
+import sys
+import asyncio
+import inspect
+import threading
 import time
 import datetime
-from dbhelper import DBHelper
-from tclient import TClient
+import functools
+from dbhelper import DBHelper, AkademieRepository
+from tclient import TClient, ERROR_CHAT_GONE, ERROR_MIGRATED, ERROR_RATE_LIMITED, ERROR_TRANSIENT
+from asynctclient import AsyncTClient
+from sendqueue import SendQueue
+from webhook import WebhookServer
+from scheduler import SubscriptionScheduler
+from spamlimiter import SpamLimiter
+from dispatcher import Dispatcher
+from profiler import Profiler
+from sharding import ShardCoordinator, shard_of
+from inline import InlineResultCache
+from router import Router
+import bulk
+import logsetup
+import metrics
 import configparser
 from html import escape
 import json
 
 logger = logging.getLogger(__name__)
 
+UPDATES_PROCESSED = metrics.REGISTRY.counter('countdown_updates_processed', 'Processed Telegram updates', ('type',))
+HANDLER_TIME = metrics.REGISTRY.histogram('countdown_handler_seconds', 'Duration of command handlers', ('command',))
+FANOUT_TIME = metrics.REGISTRY.histogram('countdown_fanout_seconds',
+                                         'Duration of subscription fan-outs until the messages are queued for sending')
+SUBSCRIPTION_LAG = metrics.REGISTRY.histogram('countdown_subscription_lag_seconds',
+                                              'Delay of sending a subscription behind its scheduled time',
+                                              buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800))
+SUBSCRIPTIONS_SENT = metrics.REGISTRY.counter('countdown_subscriptions_sent', 'Sent subscription messages')
+PRUNED_CHATS = metrics.REGISTRY.counter('countdown_pruned_chats', 'Chats removed from the subscriptions', ('reason',))
+PRUNED_SUBSCRIPTIONS = metrics.REGISTRY.counter('countdown_pruned_subscriptions',
+                                                'Subscriptions removed with unreachable chats')
+MIGRATED_CHATS = metrics.REGISTRY.counter('countdown_migrated_chats',
+                                          'Group chats whose subscriptions moved to their new supergroup')
+LIVE_COUNTDOWN_UPDATES = metrics.REGISTRY.counter('countdown_live_updates', 'Updates of live countdown messages',
+                                                  ('result',))
+
+# Subscription types: A new countdown message every day or a single (pinned) countdown message, which is edited daily
+DAILY_SUBSCRIPTION = '1'
+LIVE_SUBSCRIPTION = '2'
+LIVE_COUNTDOWN_HEADER = 'Live-Countdown (wird täglich aktualisiert):\n\n'
+# States of outbox messages (see DBHelper.enqueue_outbox())
+OUTBOX_SENT = 1
+OUTBOX_FAILED = 2
+# Outbox messages which failed temporarily (e.g. network errors or a full send queue) are sent again after
+# OUTBOX_RETRY_DELAY seconds, doubled for each further attempt, and given up after OUTBOX_MAX_ATTEMPTS attempts.
+# Pending messages are looked for every OUTBOX_RETRY_DELAY seconds.
+OUTBOX_RETRY_DELAY = 60
+OUTBOX_MAX_ATTEMPTS = 5
+
+# Subscriptions missed during a downtime are caught up in steps of this length of schedule time. A step is only taken
+# while at most CATCHUP_QUEUE_LIMIT messages are waiting in the send queue, so that replies to commands are not
+# delayed by the whole catch-up.
+CATCHUP_STEP = datetime.timedelta(minutes=1)
+CATCHUP_QUEUE_LIMIT = 100
+# Time (in seconds) to wait before checking the send queue again while the catch-up is held back
+CATCHUP_BACKOFF = 2
+# Interval (in seconds) of the log report about pruned chats
+PRUNING_REPORT_INTERVAL = 86400
+# Maximum number of academies included in the results of /list <text> and /countdown <text>
+SEARCH_LIMIT = 10
+# Maximum duration (in seconds) and number of updates of a /profile run
+PROFILE_MAX_DURATION = 3600
+PROFILE_MAX_UPDATES = 10000
+
+# Handlers of the commands and callback queries, see CountdownBot._dispatch_update()
+ROUTER = Router()
+
+
+@ROUTER.middleware()
+def _timed(_bot, route, handler):
+    """
+    Record the duration of each handler call in the HANDLER_TIME histogram and log it.
+    """
+    label = route.name if route.kind == 'command' else 'callback ' + route.name
+    
+    def timed(chat_id, args, update):
+        start = time.perf_counter()
+        try:
+            return handler(chat_id, args, update)
+        finally:
+            latency = time.perf_counter() - start
+            HANDLER_TIME.observe(latency, label)
+            logger.debug("Handled %s in chat %s in %.1f ms", label, chat_id, latency * 1000,
+                         extra={'chat_id': chat_id, 'command': label, 'latency': latency})
+    return timed
+
+
+@ROUTER.middleware('admin')
+def _admin_only(bot, route, handler):
+    """
+    Only call the handler if the user has privileged access. Otherwise, tell the user (in place of the inline keyboard
+    for callback queries).
+    """
+    def admin_only(chat_id, args, update):
+        if route.kind == 'callback':
+            if not bot._check_privilege(update["callback_query"]["from"]["id"]):
+                bot.tclient.edit_message_text(
+                    'Du hast leider nicht die erforderliche Berechtigung um diesen Befehl auszuführen :/',
+                    chat_id,
+                    update["callback_query"]["message"]["message_id"])
+                return None
+        elif not bot._check_privilege(update["message"]["from"]["id"]):
+            bot.tclient.send_message(
+                'Du hast leider nicht die erforderliche Berechtigung um diesen Befehl auszuführen :/',
+                chat_id)
+            return None
+        return handler(chat_id, args, update)
+    return admin_only
+
+
+@ROUTER.middleware('spam_limited')
+def _spam_limited(bot, _route, handler):
+    """
+    Rate limit the handler in group chats (see CountdownBot._too_much_spam()).
+    """
+    def spam_limited(chat_id, args, update):
+        if bot._too_much_spam(update):
+            return None
+        return handler(chat_id, args, update)
+    return spam_limited
+
+
+@ROUTER.middleware('private_only')
+def _private_only(bot, _route, handler):
+    """
+    Ignore the command in group chats.
+    """
+    def private_only(chat_id, args, update):
+        if bot._is_group(update):
+            return None
+        return handler(chat_id, args, update)
+    return private_only
+
 
 class CountdownBot:
-    def __init__(self, db, tclient, admins, spam_protection_time):
+    def __init__(self, db, tclient, admins, spam_protection_time, workers=1, profile_dir='.'):
         """
         Initialize a CountdownBot object using the given database connector and telegram client object
         :param db: A DBHelper to connect to the SQLite database
@@ -22,47 +157,377 @@ class CountdownBot:
         :type tclient: TClient
         :param admins: A list of user_ids that have privileged access to execute management operations
         :type admins: [int]
+        :param workers: Number of threads to process updates of different chats concurrently. With 1, updates are
+                        processed by the calling thread. Must be 1 with an AsyncTClient.
+        :type workers: int
+        :param profile_dir: Directory to write the results of /profile runs to
+        :type profile_dir: str
         """
         self.db = db
         self.tclient = tclient
         self.admins = admins
         self.spam_protection_time = spam_protection_time
+        self.akademien = AkademieRepository(db)
+        self.spam_limiter = SpamLimiter(db, spam_protection_time)
+        self.scheduler = SubscriptionScheduler()
+        self.scheduler.load(db)
+        self._data_version = db.get_data_version()
+        self._subscriptions_signature = db.get_subscriptions_signature()
+        # Rendered countdown messages of the current day: name_filter -> (message, stickers)
+        self._countdown_cache = {}
+        self._countdown_cache_key = None
+        self._countdown_cache_lock = threading.Lock()
+        self.inline_results = InlineResultCache(self.akademien,
+                                                 lambda a: self._render_akademie_countdown((a.name,))[0])
+        self.profiler = Profiler(profile_dir)
+        # Handler chains (with their middleware) of the commands and callback queries, by command
+        routes = ROUTER.bind(self)
+        self._command_handlers = routes['command']
+        self._callback_handlers = routes['callback']
+        # Keys of outbox messages being sent, (state, key) pairs of sent ones and (not_before, key) pairs of ones to
+        # retry, which are not marked in the database yet
+        self._outbox_in_flight = set()
+        self._outbox_done = []
+        self._outbox_retries = []
+        self._outbox_lock = threading.Lock()
+        self._last_outbox_retry = time.monotonic()
+        # Number of pruned chats by reason and their subscriptions since the start, for the pruning report
+        self._pruned_chats = collections.Counter()
+        self._pruned_subscriptions = 0
+        # Number of group chats migrated to a supergroup since the start (not pruned, they keep their subscriptions)
+        self._migrated_chats = 0
+        self._last_pruning_report = time.monotonic()
+        # Shards whose outbox messages this process delivers as (shard, shard count) pairs or None for all messages.
+        # Set by the main loop in sharded mode, so that messages to chats of other processes are not sent twice.
+        self.shards = None
+        # Identifier of this process for claiming outbox messages (see DBHelper.claim_outbox()) in sharded mode or
+        # None, if no other process sends messages
+        self.outbox_owner = None
+        # Set when outbox messages have been moved to a migrated chat and have to be sent again
+        self._outbox_migrated = False
+        metrics.REGISTRY.gauge('countdown_outbox_pending', 'Subscription messages waiting in the outbox',
+                               function=lambda: self.db.get_outbox_stats()[0])
+        metrics.REGISTRY.gauge('countdown_outbox_age_seconds', 'Time since the oldest waiting message was due',
+                               function=lambda: max(0, time.time() - (self.db.get_outbox_stats()[1] or time.time())))
+        self.dispatcher = Dispatcher(self.handle_update, workers) if workers > 1 else None
+        if self.dispatcher:
+            metrics.REGISTRY.gauge('countdown_dispatcher_pending', 'Updates waiting for or in processing',
+                                   function=lambda: self.dispatcher.pending)
     
-    def send_subscriptions(self, subscription, interval=None, max_age=datetime.timedelta(minutes=5)):
+    def stop(self):
+        """
+        Wait for all updates being processed by the dispatcher to finish and stop its worker threads.
+        """
+        if self.dispatcher:
+            self.dispatcher.close()
+    
+    def refresh(self):
+        """
+        Pick up changes of the academies and subscriptions made to the database by other processes. This is cheap if
+        nothing has changed, so it may be called in every iteration of the main loop.
+        """
+        with self.profiler.section():
+            data_version = self.db.get_data_version()
+            if data_version == self._data_version:
+                return
+            self._data_version = data_version
+            
+            if self.akademien.refresh_if_changed():
+                logger.info("Academies have been changed externally and were reloaded")
+            signature = self.db.get_subscriptions_signature()
+            if signature != self._subscriptions_signature:
+                self._subscriptions_signature = signature
+                self.scheduler.load(self.db)
+                logger.info("Subscriptions have been changed externally and were reloaded")
+    
+    def flush(self, force=False):
+        """
+        Persist state kept in memory (like the group chat spam protection and the sent outbox messages) to the
+        database.
+
+        :param force: If False, the state is only persisted if its flush interval has passed. Use True on shutdown.
+        """
+        with self.profiler.section():
+            self.spam_limiter.flush(force)
+            if force and hasattr(self.tclient, 'join'):
+                # Wait for the queued messages, so that the outbox messages among them are marked as done
+                self.tclient.join(30)
+            self._mark_outbox_done()
+            if self._outbox_migrated or time.monotonic() - self._last_outbox_retry >= OUTBOX_RETRY_DELAY:
+                # Send the messages moved to migrated chats and retry failed messages
+                self._outbox_migrated = False
+                self._last_outbox_retry = time.monotonic()
+                self.deliver_own_outbox()
+            if force:
+                self.db.flush()
+            if force or time.monotonic() - self._last_pruning_report >= PRUNING_REPORT_INTERVAL:
+                self._last_pruning_report = time.monotonic()
+                self.report_pruning()
+            else:
+                self.db.maybe_flush()
+    
+    def restore_update_offset(self):
+        """
+        Continue polling for updates after the last processed update, instead of receiving the updates of the last
+        batch before a restart again.
+        """
+        offset = self.db.get_state('update_offset')
+        if offset:
+            self.tclient.set_update_offset(int(offset))
+            logger.info("Restored update offset %s", offset)
+    
+    def load_subscription_watermark(self):
+        """
+        :return: The time up to which subscriptions have been delivered before the last restart or None
+        :rtype: datetime.datetime or None
+        """
+        watermark = self.db.get_state('subscription_watermark')
+        return datetime.datetime.strptime(watermark, '%Y-%m-%d %H:%M:%S.%f') if watermark else None
+    
+    def save_subscription_watermark(self, watermark):
+        """
+        Store the time up to which subscriptions have been delivered.
+
+        :type watermark: datetime.datetime
+        """
+        self.db.set_state('subscription_watermark', watermark.strftime('%Y-%m-%d %H:%M:%S.%f'), durable=True)
+    
+    def next_subscription_time(self, after):
+        """
+        Get the time the next subscription is due after the given point in time.
+
+        :type after: datetime.datetime
+        :return: The time of the next subscription or None if there are no subscriptions
+        :rtype: datetime.datetime or None
+        """
+        return self.scheduler.next_due(after)
+    
+    def send_subscriptions(self, subscription, interval=None, max_age=datetime.timedelta(minutes=5), shard=None):
         """
         Send countdown messages to subscribers. By default this method sends a message for each subscription that was
         due within the last five minutes. To enlarge this period, pass another value for `max_age`. Additionally
         subscriptions can be filtered to be within a time interval. This should be used for periodic evauluation of this
         function.
 
-        :param subscription: ?
-        :type subscription: str
+        :param subscription: Only send subscriptions of this type (DAILY_SUBSCRIPTION or LIVE_SUBSCRIPTION) or all
+                             subscriptions if None
+        :type subscription: str or None
         :param interval: An interval between the last check/sending of subscriptions and now. Only subscriptions in this
-                         interval are processed. To force sending of all subscriptions, use None.
+                         interval are processed. To force sending of all subscriptions (of the last 24 hours), use
+                         None.
         :type interval: (datetime.datetime, datetime.datetime) or None
         :param max_age: Maximum age of a subscription to send. To send all subscriptions, set to datetime.timedelta.max
         :type max_age: datetime.timedelta
+        :param shard: Only send subscriptions of chats in this shard (see `sharding.shard_of()`)
+        :type shard: (int, int) or None
+        :return: The number of sent subscriptions
         """
-        # print("sending Subscriptions")
+        now = interval[1] if interval else datetime.datetime.utcnow()
         
-        subscribers = self.db.get_subscriptions(subscription)
+        # Only look up the subscriptions in the interval and not older than max_age
+        start = now - min(max_age, datetime.timedelta(days=1))
+        if interval:
+            start = max(start, interval[0])
         
-        now = interval[1] if interval else datetime.datetime.now()
+        fanout_start = time.perf_counter()
+        with self.profiler.section():
+            # Enqueue a message for each subscription and scheduled time in the outbox. The key makes the enqueueing
+            # idempotent, so a subscription is never delivered twice for the same day.
+            entries = []
+            for chat_id, subscription_type, sub_time in self.scheduler.due(start, now, subscription):
+                if shard and shard_of(chat_id, shard[1]) != shard[0]:
+                    continue
+                scheduled = datetime.datetime.combine(now.date(), datetime.time.fromisoformat(sub_time))
+                if scheduled > now:
+                    scheduled -= datetime.timedelta(days=1)
+                # Due at the scheduled time (in UTC), also when caught up later
+                due = scheduled.replace(tzinfo=datetime.timezone.utc).timestamp()
+                entries.append(('{}@{}'.format(chat_id, scheduled.strftime('%Y-%m-%d %H:%M:%S')), chat_id,
+                                subscription_type, sub_time, due))
+            if entries:
+                enqueued = self.db.enqueue_outbox(entries)
+                logger.debug("Enqueued %s of %s due subscriptions", enqueued, len(entries))
+            sent = self.deliver_outbox(shard) if shard else self.deliver_own_outbox()
+        FANOUT_TIME.observe(time.perf_counter() - fanout_start)
+        return sent
+    
+    def deliver_outbox(self, shard=None, batch_size=500):
+        """
+        Send the pending messages of the outbox, oldest first. Each message is marked as done, when its result is
+        available. After a restart, this continues with the messages which have not been sent before. If `outbox_owner`
+        is set, messages are claimed before sending them, so that messages queued by another process are skipped.
+
+        :param shard: Only send messages to chats in this shard (see `sharding.shard_of()`)
+        :type shard: (int, int) or None
+        :param batch_size: Number of messages to load from the database at once
+        :return: The number of messages handed to the client (their results may still be pending)
+        """
+        sent = 0
+        with self.profiler.section():
+            self._mark_outbox_done()
+            after = None
+            while True:
+                entries = self.db.get_pending_outbox(batch_size, after)
+                if not entries:
+                    break
+                after = (entries[-1][4], entries[-1][0])
+                entries = [entry for entry in entries if not shard or shard_of(entry[1], shard[1]) == shard[0]]
+                # /send_subscriptions delivers in a dispatcher thread, concurrently to the main loop
+                with self._outbox_lock:
+                    entries = [entry for entry in entries if entry[0] not in self._outbox_in_flight]
+                    self._outbox_in_flight.update(entry[0] for entry in entries)
+                if self.outbox_owner and entries:
+                    # Skip messages queued by another process, which held their shard before
+                    claimed = set()
+                    try:
+                        claimed.update(self.db.claim_outbox([entry[0] for entry in entries], self.outbox_owner))
+                    finally:
+                        with self._outbox_lock:
+                            self._outbox_in_flight.difference_update(entry[0] for entry in entries
+                                                                     if entry[0] not in claimed)
+                    entries = [entry for entry in entries if entry[0] in claimed]
+                for key, chat_id, subscription_type, sub_time, due, attempts in entries:
+                    logger.debug("Sending %s-subscription to chat %s", sub_time, chat_id, extra={'chat_id': chat_id})
+                    try:
+                        result = self._deliver_subscription(chat_id, subscription_type, sub_time)
+                    except Exception as e:
+                        logger.error("Error while sending subscription to chat %s:", chat_id, exc_info=e)
+                        result = {}
+                    _on_result(result, functools.partial(self._outbox_delivered, key, chat_id, due, attempts))
+                    sent += 1
+            self._mark_outbox_done()
+        return sent
+    
+    def deliver_own_outbox(self):
+        """
+        Send the pending outbox messages of the shards of this process (see `shards`).
+
+        :return: The number of sent messages
+        """
+        if self.shards is None:
+            return self.deliver_outbox()
+        return sum(self.deliver_outbox(shard) for shard in sorted(self.shards))
+    
+    def _deliver_subscription(self, chat_id, subscription_type, sub_time):
+        """
+        Send the countdown message of a subscription.
+
+        :return: The result of the countdown message's request or None if no request was necessary
+        """
+        if subscription_type == LIVE_SUBSCRIPTION:
+            return self._update_live_countdown(chat_id)
         
-        for s in subscribers:
-            # Get last subscription of the subscriber
-            sub_time = datetime.datetime.combine(now.date(), datetime.datetime.strptime(s[1], "%H:%M:%S").time())
-            if sub_time > now:
-                sub_time -= datetime.timedelta(days=1)
-            
-            # Check if subscription was in interval
-            in_interval = interval is None or interval[0] < sub_time <= interval[1]
-            not_too_old = (now - sub_time) <= max_age
-            if in_interval and not_too_old:
-                logger.debug("Sending {}-subscription to chat {}".format(s[1], s[0]))
-                self._print_akademie_countdown(
-                    s[0],
-                    pre_text='Dies ist deine für {} Uhr(UTC) abonnierte Nachricht:\n\n'.format(s[1]))
+        msg, sticker_list = self._render_akademie_countdown()
+        if msg is None:
+            return self.tclient.send_message('Es sind noch keine Akademien mit Datum eingespeichert :\'(', chat_id)
+        result = self.tclient.send_message(
+            'Dies ist deine für {} Uhr(UTC) abonnierte Nachricht:\n\n'.format(sub_time) + msg, chat_id)
+        for sticker in sticker_list:
+            self.tclient.send_sticker(sticker, chat_id)
+        return result
+    
+    def _outbox_delivered(self, key, chat_id, due, attempts, result):
+        """
+        Handle the result of an outbox message: Mark it as sent or failed or schedule a retry if it failed temporarily.
+
+        :param due: The time the message has been scheduled for (as returned by time.time())
+        :param attempts: Number of previous attempts to send the message
+        """
+        if result is None or result.get('ok'):
+            SUBSCRIPTION_LAG.observe(time.time() - due)
+            SUBSCRIPTIONS_SENT.inc()
+            with self._outbox_lock:
+                self._outbox_done.append((OUTBOX_SENT, key))
+            return
+        
+        error = result.get('error')
+        if error == ERROR_CHAT_GONE:
+            self._prune_chat(chat_id, 'unreachable')
+        elif error == ERROR_MIGRATED:
+            self._migrate_chat(chat_id, result['parameters']['migrate_to_chat_id'])
+        # Results without error class come from exceptions while sending
+        retry = error in (ERROR_TRANSIENT, ERROR_RATE_LIMITED, None) and attempts + 1 < OUTBOX_MAX_ATTEMPTS
+        with self._outbox_lock:
+            if retry:
+                self._outbox_retries.append((time.time() + OUTBOX_RETRY_DELAY * 2 ** attempts, key))
+            else:
+                self._outbox_done.append((OUTBOX_FAILED, key))
+    
+    def _mark_outbox_done(self):
+        """
+        Mark the outbox messages whose results have arrived as done or to be retried in the database (in a single
+        transaction).
+        """
+        with self._outbox_lock:
+            done, self._outbox_done = self._outbox_done, []
+            retries, self._outbox_retries = self._outbox_retries, []
+        if done or retries:
+            try:
+                self.db.mark_outbox(done, retries)
+            except Exception:
+                # Keep the results for the next attempt, the messages must not be sent again in between
+                with self._outbox_lock:
+                    self._outbox_done[:0] = done
+                    self._outbox_retries[:0] = retries
+                raise
+            # Only forget the keys after marking them, so that they are not sent again in between
+            with self._outbox_lock:
+                self._outbox_in_flight.difference_update(key for _state, key in done + retries)
+    
+    def _prune_chat(self, chat_id, reason):
+        """
+        Remove a chat the bot can't send messages to anymore, so that no more subscriptions are sent to it.
+
+        :param reason: Reason for the metrics and the pruning report, e.g. 'unreachable' (a request failed
+                       permanently) or 'left' (the bot has been blocked or removed from the chat)
+        """
+        removed = self.db.prune_chat(chat_id)
+        self.scheduler.remove(chat_id)
+        if not removed:
+            return
+        with self._outbox_lock:
+            self._pruned_chats[reason] += 1
+            self._pruned_subscriptions += removed
+        PRUNED_CHATS.inc(reason)
+        PRUNED_SUBSCRIPTIONS.inc(amount=removed)
+    
+    def _migrate_chat(self, chat_id, new_chat_id):
+        """
+        Move the subscriptions of a group, which has been upgraded to a supergroup, to the supergroup's chat id.
+        """
+        self.db.migrate_chat(chat_id, new_chat_id)
+        self.scheduler.load(self.db)
+        self._outbox_migrated = True
+        with self._outbox_lock:
+            self._migrated_chats += 1
+        MIGRATED_CHATS.inc()
+    
+    def report_pruning(self):
+        """
+        Log how much fan-out work has been saved by pruning unreachable chats since the start and how many group chats
+        have been migrated to supergroups (which does not save any work).
+
+        :return: The report or None if no chat has been pruned or migrated
+        """
+        with self._outbox_lock:
+            pruned_chats = dict(self._pruned_chats)
+            pruned_subscriptions = self._pruned_subscriptions
+            migrated_chats = self._migrated_chats
+        if not pruned_chats and not migrated_chats:
+            return None
+        parts = []
+        if pruned_chats:
+            subscriptions = len(self.scheduler)
+            parts.append("Pruned chats since the start: {}. Their removed subscriptions save {} requests per day "
+                         "({:.1%} of the daily fan-out).".format(
+                             ', '.join('{} {}'.format(n, reason) for reason, n in sorted(pruned_chats.items())),
+                             pruned_subscriptions,
+                             pruned_subscriptions / ((subscriptions + pruned_subscriptions) or 1)))
+        if migrated_chats:
+            parts.append("Group chats migrated to supergroups since the start: {}.".format(migrated_chats))
+        report = ' '.join(parts)
+        logger.info(report)
+        return report
     
     def await_and_process_updates(self, timeout=10):
         """
@@ -75,36 +540,67 @@ class CountdownBot:
         updates = self.tclient.get_updates(timeout=timeout)
         # Process updates
         for update in updates:
-            try:
+            self.process_update(update)
+        self._save_update_offset(updates)
+    
+    def process_update(self, update):
+        """
+        Process a single update, e.g. received via webhook. If the bot has a dispatcher, the update is handed over to
+        its worker threads, otherwise it is processed immediately.
+
+        :param update: A Telegram update to be processed
+        :type update: dict
+        """
+        if self.dispatcher:
+            self.dispatcher.submit(update)
+        else:
+            self.handle_update(update)
+    
+    def handle_update(self, update):
+        """
+        Process a single update in the calling thread, logging any errors.
+
+        :param update: A Telegram update to be processed
+        :type update: dict
+        """
+        try:
+            with self.profiler.section(update=True):
                 self._dispatch_update(update)
+        except Exception as e:
+            logger.error("Error while processing a Telegram update:", exc_info=e)
+    
+    async def await_and_process_updates_async(self, timeout=10):
+        """
+        Asynchronous variant of `await_and_process_updates()` for use with an AsyncTClient. Handlers returning an
+        awaitable are awaited before the next update is processed.
+
+        :param timeout: How long to wait on the Telegram API for updates (in seconds)
+        :type timeout: int
+        """
+        updates = await self.tclient.get_updates(timeout=timeout)
+        for update in updates:
+            try:
+                with self.profiler.section(update=True):
+                    result = self._dispatch_update(update)
+                if inspect.isawaitable(result):
+                    await result
             except Exception as e:
                 logger.error("Error while processing a Telegram update:", exc_info=e)
+        self._save_update_offset(updates)
+    
+    def _save_update_offset(self, updates):
+        if updates:
+            self.db.set_state('update_offset', max(u['update_id'] for u in updates) + 1)
     
     def _dispatch_update(self, update):
         """
         Process an update received from the Telegram API in the context of this Bot.
         :param update: A Telegram update to be processed
         :type update: dict
+        :return: The result of the handler. Handlers may be coroutine functions, in this case the result has to be
+                 awaited.
         """
-        command_handlers = {
-            '/start': self._do_start,
-            '/help': self._do_help,
-            '/list': self._do_list,
-            '/countdown': self._do_countdown,
-            '/subscribe': self._do_subscribe,
-            '/unsubscribe': self._do_unsubscribe,
-            '/now': self._do_now,
-            '/add_akademie': self._do_add,
-            '/delete_akademie': self._do_delete,
-            '/edit_akademie': self._do_edit,
-            '/send_subscriptions': self._do_send_subscriptions,
-            '/get_subscriptions': self._do_get_subscriptions,
-            '/workshop': self._do_sarcastic_response,
-            }
-        callback_handlers = {
-            '/delete_akademie': self._callback_delete,
-            '/close_inline_keyboard': self._callback_close_inline_keyboard
-            }
+        UPDATES_PROCESSED.inc(next((t for t in update if t != 'update_id'), 'unknown'))
         
         if "message" in update:
             # Parse command
@@ -112,14 +608,24 @@ class CountdownBot:
                 args = update["message"]["text"].split(' ', 1)
                 command = args[0].replace('@cde_akademie_countdown_bot', '').lower()
                 chat_id = update["message"]["chat"]["id"]
-                logger.debug("Processing message from chat {}: {}".format(chat_id, update["message"]["text"]))
-                try:
-                    command_handlers[command](chat_id, args, update)
-                except KeyError:
-                    if command.startswith('/'):
-                        if not self._is_group(update):
-                            self.tclient.send_message('Unbekannter Befehl. Versuch es mal mit /help', chat_id)
-                        logger.error("Unknown command received: '{}'".format(update["message"]["text"]))
+                logger.debug("Processing message from chat %s: %s", chat_id, update["message"]["text"],
+                             extra={'chat_id': chat_id, 'command': command})
+                handler = self._command_handlers.get(command)
+                if handler is not None:
+                    return handler(chat_id, args, update)
+                if command.startswith('/'):
+                    if not self._is_group(update):
+                        self.tclient.send_message('Unbekannter Befehl. Versuch es mal mit /help', chat_id)
+                    logger.error("Unknown command received: '%s'", update["message"]["text"])
+            elif "document" in update["message"]:
+                # Documents are imported if their caption is /import_akademien
+                command = update["message"].get("caption", "").split(' ', 1)[0]
+                command = command.replace('@cde_akademie_countdown_bot', '').lower()
+                if command == '/import_akademien':
+                    chat_id = update["message"]["chat"]["id"]
+                    return self._command_handlers[command](chat_id, [command], update)
+            elif "migrate_to_chat_id" in update["message"]:
+                self._migrate_chat(update["message"]["chat"]["id"], update["message"]["migrate_to_chat_id"])
             elif "sticker" in update["message"]:
                 if self._check_privilege(update["message"]["from"]["id"]):
                     self.tclient.send_message("{}".format(update["message"]["sticker"]["file_id"]),
@@ -129,129 +635,186 @@ class CountdownBot:
             args = update["callback_query"]["data"].split(' ', 1)
             command = args[0].replace('@cde_akademie_countdown_bot', '').lower()
             chat_id = update["callback_query"]["message"]["chat"]["id"]
-            logger.debug(
-                "Processing callback request from chat {}: {}".format(chat_id, update["callback_query"]["data"]))
-            try:
-                callback_handlers[command](chat_id, args, update)
-            except KeyError:
-                logger.error("Callback request for unknown command received: '{}'"
-                             .format(update["callback_query"]["data"]))
+            logger.debug("Processing callback request from chat %s: %s", chat_id, update["callback_query"]["data"],
+                         extra={'chat_id': chat_id, 'command': 'callback ' + command})
+            handler = self._callback_handlers.get(command)
+            if handler is not None:
+                return handler(chat_id, args, update)
+            logger.error("Callback request for unknown command received: '%s'", update["callback_query"]["data"])
+        
+        elif "inline_query" in update:
+            with HANDLER_TIME.time('inline_query'):
+                return self._do_inline_query(update)
+        
+        elif "my_chat_member" in update:
+            # The bot has been blocked by a user or removed from a group
+            if update["my_chat_member"]["new_chat_member"]["status"] in ('kicked', 'left'):
+                self._prune_chat(update["my_chat_member"]["chat"]["id"], 'left')
     
-    def _do_start(self, chat_id, _args, update):
+    def _do_inline_query(self, update):
+        """
+        Answer an inline query (@bot <name>) with the countdowns of the matching upcoming academies. The results are
+        taken from the precomputed InlineResultCache.
+        """
+        query = update["inline_query"]
+        logger.debug("Processing inline query from user %s: %s", query["from"]["id"], query["query"])
+        return self.tclient.answer_inline_query(query["id"], self.inline_results.answer(query["query"]))
+    
+    @ROUTER.command('/start', spam_limited=True)
+    def _do_start(self, chat_id, _args, _update):
         """
         Handle a /start command. Just send a 'hello' to the user.
         """
-        if not self._too_much_spam(update):
-            self.tclient.send_message('Hallo! Ich bin ein Bot, um die Tage bis zur nächsten CdE Akademie zu zählen!',
-                                      chat_id)
+        self.tclient.send_message('Hallo! Ich bin ein Bot, um die Tage bis zur nächsten CdE Akademie zu zählen!',
+                                  chat_id)
     
+    @ROUTER.command('/workshop', private_only=True)
     def _do_sarcastic_response(self, chat_id, _args, update):
         """
         Respond to certain Easteregg commands
         """
-        # Do not do this in groups
-        if self._is_group(update):
-            return
-        
         user_first_name = update["message"]["from"]["first_name"]
         user_last_name = update["message"]["from"]["last_name"] if "last_name" in update["message"]["from"] else ''
         user_name = user_first_name + (' ' + user_last_name if user_last_name != '' else '')
         
         self.tclient.send_message('🙄 {} spammt schon wieder!'.format(user_name), chat_id)
     
-    def _do_help(self, chat_id, _args, update):
+    @ROUTER.command('/help', spam_limited=True)
+    def _do_help(self, chat_id, _args, _update):
         """
         Handle a /help command.
         Send a list of all available commands to the user (minus some commands only used for testing).
         """
-        if not self._too_much_spam(update):
-            self.tclient.send_message(
-                '/start - Initialisiere den Bot.\n'
-                '/help - Zeige diese Liste an.\n'
-                '/list - Liste alle gespeicherten Veranstaltungen alphabetisch auf.\n'
-                '/countdown - Erstelle einen Countdown zu allen mit Datum gespeicherten Veranstaltungen.\n'
-                '/subscribe - Abonniere tägliche Countdowns um eine bestimmte Uhrzeit (HH:MM) (UTC).\n'
-                '/unsubscribe - Entferne alle Abonnements für diesen Chat.\n'
-                '/now - Gib die aktuelle Uhrzeit (UTC) aus.\n'
-                '/add_akademie - Füge eine neue Veranstaltung hinzu. (Nur mit Administratorrechten möglich).\n'
-                '/delete_akademie - Lösche eine existierende Veranstaltung. (Nur mit Administratorrechten möglich).\n'
-                '/edit_akademie - Editiere eine existierende Veranstaltung. (Nur mit Administratorrechten möglich).\n',
-                chat_id)
+        self.tclient.send_message(
+            '/start - Initialisiere den Bot.\n'
+            '/help - Zeige diese Liste an.\n'
+            '/list - Liste alle gespeicherten Veranstaltungen alphabetisch auf. Mit /list <Name> werden nur die '
+            'passendsten Veranstaltungen aufgelistet.\n'
+            '/countdown - Erstelle einen Countdown zu allen mit Datum gespeicherten Veranstaltungen. Mit '
+            '/countdown <Name> nur zu den passendsten Veranstaltungen.\n'
+            '/subscribe - Abonniere tägliche Countdowns um eine bestimmte Uhrzeit (HH:MM) (UTC). Mit /subscribe '
+            'live [HH:MM] wird stattdessen eine angeheftete Countdown-Nachricht täglich aktualisiert.\n'
+            '/unsubscribe - Entferne alle Abonnements für diesen Chat.\n'
+            '/now - Gib die aktuelle Uhrzeit (UTC) aus.\n'
+            '/add_akademie - Füge eine neue Veranstaltung hinzu. (Nur mit Administratorrechten möglich).\n'
+            '/delete_akademie - Lösche eine existierende Veranstaltung. (Nur mit Administratorrechten möglich).\n'
+            '/edit_akademie - Editiere eine existierende Veranstaltung. (Nur mit Administratorrechten möglich).\n'
+            '/import_akademien - Importiere viele Veranstaltungen aus einer CSV- oder JSON-Datei. (Nur mit '
+            'Administratorrechten möglich).\n',
+            chat_id)
     
-    def _do_list(self, chat_id, _args, update):
+    @ROUTER.command('/list', spam_limited=True)
+    def _do_list(self, chat_id, args, _update):
         """
-        Handle a /list command. Send a list of all academies to the user
+        Handle a /list command. Send a list of all academies to the user. With a search text (/list <text>), only
+        the best matching academies are listed.
         """
-        # Do rate limit for group chat spam protection
-        if self._too_much_spam(update):
-            return
-        
-        akademien = self.db.get_akademien()
+        query = args[1].strip() if len(args) > 1 else ''
+        if query:
+            akademien = self.akademien.search(query, SEARCH_LIMIT)
+            if not akademien:
+                self.tclient.send_message('Keine passende Akademie gefunden :\'(', chat_id)
+                return
+        else:
+            akademien = self.akademien.get_akademien()
         if len(akademien) > 0:
             self._print_akademien(akademien, chat_id)
         else:
             self.tclient.send_message('Es sind noch keine Akademien eingespeichert :\'(', chat_id)
     
-    def _do_countdown(self, chat_id, _args, update):
+    @ROUTER.command('/countdown', spam_limited=True)
+    def _do_countdown(self, chat_id, args, _update):
         """
-        Handle a /countdown command. Send a list of all academies with remaining number of days to the user.
+        Handle a /countdown command. Send a list of all academies with remaining number of days to the user. With a
+        search text (/countdown <text>), only the best matching upcoming academies are included.
         """
-        # Do rate limit for group chat spam protection
-        if self._too_much_spam(update):
+        query = args[1].strip() if len(args) > 1 else ''
+        if not query:
+            self._print_akademie_countdown(chat_id)
             return
         
-        # name = escape(args[1].strip()) if len(args) > 1 else None
-        self._print_akademie_countdown(chat_id, name_filter=None)
+        today = datetime.datetime.today().date()
+        names = tuple(a.name for a in self.akademien.search(query) if a.date and a.date >= today)[:SEARCH_LIMIT]
+        if not names:
+            self.tclient.send_message('Keine passende Akademie gefunden :\'(', chat_id)
+            return
+        self._print_akademie_countdown(chat_id, name_filter=names)
     
+    @ROUTER.command('/subscribe')
     def _do_subscribe(self, chat_id, args, _update):
         """
-        Handle a /subscribe command.
+        Handle a /subscribe command. With /subscribe live, the chat gets a single pinned countdown message, which is
+        updated daily, instead of a new message every day.
         """
-        if len(args) > 1:
+        words = args[1].split() if len(args) > 1 else []
+        live = bool(words) and words[0].lower() == 'live'
+        if live:
+            words = words[1:]
+        
+        if words:
             try:
-                t = datetime.datetime.strptime(args[1], '%H:%M').strftime('%H:%M:%S')
-                self.db.add_subcription(chat_id, '1', t)
-                self.tclient.send_message(
-                    'Countdownbenachrichtigungen für täglich {} Uhr(UTC) erfolgreich abonniert!'.format(t), chat_id)
+                t = datetime.datetime.strptime(words[0], '%H:%M').strftime('%H:%M:%S')
             except ValueError:
-                self.db.add_subcription(chat_id, '1')
-                self.tclient.send_message(
-                    'Uhrzeit konnte nicht gelesen werden. Tägliche Benachrichtigungen wurden für '
-                    '06:00 Uhr(UTC) abonniert!',
-                    chat_id)
+                t = None
         else:
-            self.db.add_subcription(chat_id, '1')
+            t = '06:00:00'
+        
+        if live:
+            self._add_subscription(chat_id, LIVE_SUBSCRIPTION, t or '06:00:00')
+            self.tclient.send_message(
+                '{}Live-Countdown erfolgreich abonniert! Die angeheftete Countdown-Nachricht wird täglich um {} '
+                'Uhr(UTC) aktualisiert.'.format('' if t else 'Uhrzeit konnte nicht gelesen werden. ', t or '06:00:00'),
+                chat_id)
+            self._update_live_countdown(chat_id)
+        elif not t:
+            self._add_subscription(chat_id, DAILY_SUBSCRIPTION, '06:00:00')
+            self.tclient.send_message(
+                'Uhrzeit konnte nicht gelesen werden. Tägliche Benachrichtigungen wurden für '
+                '06:00 Uhr(UTC) abonniert!',
+                chat_id)
+        elif words:
+            self._add_subscription(chat_id, DAILY_SUBSCRIPTION, t)
+            self.tclient.send_message(
+                'Countdownbenachrichtigungen für täglich {} Uhr(UTC) erfolgreich abonniert!'.format(t), chat_id)
+        else:
+            self._add_subscription(chat_id, DAILY_SUBSCRIPTION, t)
             self.tclient.send_message('Tägliche Benachrichtigungen für 06:00 Uhr(UTC) '
                                       'erfolgreich abonniert!',
                                       chat_id)
     
+    def _add_subscription(self, chat_id, subscription, t):
+        """
+        Add a subscription, replacing a subscription of another type at the same time.
+        """
+        if self.db.get_subscription_type(chat_id, t) not in (None, subscription):
+            self.db.remove_subscription(chat_id, t)
+            self.scheduler.remove(chat_id, t)
+        self.db.add_subcription(chat_id, subscription, t)
+        self.scheduler.add(chat_id, subscription, t)
+    
+    @ROUTER.command('/unsubscribe')
     def _do_unsubscribe(self, chat_id, _args, _update):
         """
         Handle an /unsubscribe command.
         """
         self.db.remove_subscription(chat_id)
+        self.db.remove_live_message(chat_id)
+        self.scheduler.remove(chat_id)
         self.tclient.send_message(
             'Alle täglichen Benachrichtigungen für diesen Chat wurden erfolgreich gelöscht!', chat_id)
     
+    @ROUTER.command('/now')
     def _do_now(self, chat_id, _args, _update):
         """
         Handle a /now command. Just respond with the current UTC time.
         """
         self.tclient.send_message(datetime.datetime.utcnow().strftime('%H:%M:%S'), chat_id)
     
-    def _do_add(self, chat_id, args, update):
+    @ROUTER.command('/add_akademie', admin=True)
+    def _do_add(self, chat_id, args, _update):
         """
         Handle an /add_akademie command.
         """
-        user_id = update["message"]["from"]["id"]
-        
-        if not self._check_privilege(user_id):
-            self.tclient.send_message(
-                'Du hast leider nicht die erforderliche Berechtigung um diesen Befehl auszuführen :/',
-                chat_id)
-            return
-        
-        akademien = self.db.get_akademien()
         if len(args) <= 1:
             self.tclient.send_message(
                 'Bitte gib einen Namen für die neue Akademie ein. Du kannst außerdem eine Beschreibung '
@@ -273,30 +836,49 @@ class CountdownBot:
             description = escape(description.strip())
             date = escape(date.strip())
             
-            for a in akademien:
-                if a.name == name:
-                    self.tclient.send_message('Es existiert bereits eine Akademie mit diesem Namen!',
-                                              chat_id)
-                    break
+            if self.akademien.get_akademie(name):
+                self.tclient.send_message('Es existiert bereits eine Akademie mit diesem Namen!',
+                                          chat_id)
             else:
-                self.db.add_akademie(name, description, date)
+                self.akademien.add_akademie(name, description, date)
                 self.tclient.send_message('Akademie {} hinzugefügt'.format(name), chat_id)
-                akademien = self.db.get_akademien()
-        self._print_akademien(akademien, chat_id)
+        self._print_akademien(self.akademien.get_akademien(), chat_id)
     
-    def _do_delete(self, chat_id, _args, update):
+    @ROUTER.command('/import_akademien', admin=True)
+    def _do_import(self, chat_id, _args, update):
         """
-        Handle an /delete_akademie command.
+        Handle an /import_akademien command: Import the academies (and subscriptions) of a CSV or JSON document, which
+        is sent with /import_akademien as caption. All entries are validated and imported in a single transaction, or
+        none of them if there are invalid entries.
         """
-        user_id = update["message"]["from"]["id"]
-        
-        if not self._check_privilege(user_id):
+        document = update["message"].get("document")
+        if not document:
             self.tclient.send_message(
-                'Du hast leider nicht die erforderliche Berechtigung um diesen Befehl auszuführen :/',
+                'Bitte schicke eine CSV-Datei (Spalten name, description, date) oder eine JSON-Datei mit '
+                '/import_akademien als Beschreibung.',
                 chat_id)
             return
-        
-        akademien = self.db.get_akademien()
+        _on_result(self.tclient.download_file(document["file_id"]),
+                   functools.partial(self._import_document, chat_id, document.get("file_name", "")))
+    
+    def _import_document(self, chat_id, filename, content):
+        if content is None:
+            self.tclient.send_message('Die Datei konnte nicht geladen werden (maximal 1 MB).', chat_id)
+            return
+        data = bulk.parse(content, filename)
+        added = updated = 0
+        if data and not data.errors:
+            added, updated = self.akademien.import_akademien(data.akademien, data.subscriptions)
+            if data.subscriptions:
+                self.scheduler.load(self.db)
+        self.tclient.send_message(escape(bulk.summary(data, added, updated)), chat_id)
+    
+    @ROUTER.command('/delete_akademie', admin=True)
+    def _do_delete(self, chat_id, _args, _update):
+        """
+        Handle an /delete_akademie command.
+        """
+        akademien = self.akademien.get_akademien()
         keyboard = [[{"text": a.name,
                       "callback_data": '/delete_akademie {}'.format(a.name)}]
                     for a in akademien]
@@ -305,18 +887,11 @@ class CountdownBot:
         self.tclient.send_message('Wähle eine Akademie aus die gelöscht werden soll', chat_id,
                                   json.dumps({"inline_keyboard": keyboard}))
     
-    def _do_edit(self, chat_id, args, update):
+    @ROUTER.command('/edit_akademie', admin=True)
+    def _do_edit(self, chat_id, args, _update):
         """
         Handle an /edit_akademie command.
         """
-        user_id = update["message"]["from"]["id"]
-        
-        if not self._check_privilege(user_id):
-            self.tclient.send_message(
-                'Du hast leider nicht die erforderliche Berechtigung um diesen Befehl auszuführen :/',
-                chat_id)
-            return
-        
         if len(args) <= 1:
             self.tclient.send_message(
                 'Bitte gib an, welche Akademie du ändern willst.\n'
@@ -335,62 +910,86 @@ class CountdownBot:
                     'Beim Einlesen deiner Änderung ist ein Fehler aufgetreten :(\n'
                     'Wahrscheinlich hast du zu wenige Argumente angegeben.',
                     chat_id)
-                logger.error("Could not parse arguments of akademie edit: {}".format(args), exc_info=e)
+                logger.error("Could not parse arguments of akademie edit: %s", args, exc_info=e)
             else:
-                self.db.edit_akademie(name, new_name, new_description, new_date)
-                akademien = self.db.get_akademien()
-                self._print_akademien(akademien, chat_id)
+                # Names are unique
+                if new_name and new_name != name and self.akademien.get_akademie(new_name):
+                    self.tclient.send_message('Es existiert bereits eine Akademie mit diesem Namen!', chat_id)
+                elif self.akademien.edit_akademie(name, new_name, new_description, new_date):
+                    self._print_akademien(self.akademien.get_akademien(), chat_id)
+                else:
+                    self.tclient.send_message('Keine Akademie unter diesem Namen gefunden.', chat_id)
     
-    def _do_send_subscriptions(self, chat_id, _args, update):
+    @ROUTER.command('/send_subscriptions', admin=True)
+    def _do_send_subscriptions(self, chat_id, _args, _update):
         """
         Handle a /send_subscriptions command.
         """
-        user_id = update["message"]["from"]["id"]
-        
-        if not self._check_privilege(user_id):
-            self.tclient.send_message(
-                'Du hast leider nicht die erforderliche Berechtigung um diesen Befehl auszuführen :/',
-                chat_id)
-            return
-        
-        self.send_subscriptions('1', max_age=datetime.timedelta.max)
+        self.send_subscriptions(None, max_age=datetime.timedelta.max)
     
-    def _do_get_subscriptions(self, chat_id, _args, update):
+    @ROUTER.command('/get_subscriptions', admin=True)
+    def _do_get_subscriptions(self, chat_id, _args, _update):
         """
         Handle a /get_subscriptions command.
         """
+        print(self.db.get_subscriptions(DAILY_SUBSCRIPTION))
+    
+    @ROUTER.command('/profile', admin=True)
+    def _do_profile(self, chat_id, args, update):
+        """
+        Handle a /profile command: Profile the bot for the next N seconds (`/profile 60`) or N updates
+        (`/profile 100 updates`) and send the hottest functions to the requesting admin. `/profile stop` ends a run
+        early.
+        """
         user_id = update["message"]["from"]["id"]
         
-        if not self._check_privilege(user_id):
-            self.tclient.send_message(
-                'Du hast leider nicht die erforderliche Berechtigung um diesen Befehl auszuführen :/',
-                chat_id)
+        options = args[1].split() if len(args) > 1 else []
+        if options[:1] == ['stop']:
+            if self.profiler.stop() is None:
+                self.tclient.send_message('Es läuft gerade keine Profilierung.', chat_id)
+            return
+        
+        try:
+            amount = int(options[0]) if options else 30
+        except ValueError:
+            amount = 0
+        if amount <= 0:
+            self.tclient.send_message('Syntax: /profile [Anzahl > 0] [s|updates] oder /profile stop', chat_id)
             return
         
-        print(self.db.get_subscriptions('1'))
+        def report(summary, _path):
+            self.tclient.send_message('<pre>{}</pre>'.format(escape(summary, quote=False)), user_id)
+        
+        if options[1:2] and options[1].startswith('update'):
+            # Limit the duration of runs on updates, as updates might not arrive at all
+            amount = min(amount, PROFILE_MAX_UPDATES)
+            started = self.profiler.start(duration=PROFILE_MAX_DURATION, updates=amount, on_finish=report)
+            description = '{} Updates'.format(amount)
+        else:
+            amount = min(amount, PROFILE_MAX_DURATION)
+            started = self.profiler.start(duration=amount, on_finish=report)
+            description = '{} Sekunden'.format(amount)
+        
+        if started:
+            self.tclient.send_message('Profilierung für {} gestartet.'.format(description), chat_id)
+        else:
+            self.tclient.send_message('Es läuft bereits eine Profilierung.', chat_id)
     
+    @ROUTER.callback('/delete_akademie', admin=True)
     def _callback_delete(self, chat_id, args, update):
         """
         Handle the callback request of a /delete_akademie command.
         """
-        cq = update["callback_query"]
-        user_id = cq["from"]["id"]
-        msg_id = cq["message"]["message_id"]
-        
-        if not self._check_privilege(user_id):
-            self.tclient.edit_message_text(
-                'Du hast leider nicht die erforderlichen Berechtigung um diesen Befehl auszuführen :/'.format(args[1]),
-                chat_id,
-                msg_id)
-            return
+        msg_id = update["callback_query"]["message"]["message_id"]
         
         if len(args) > 1:
-            self.db.delete_akademie(args[1])
+            self.akademien.delete_akademie(args[1])
             self.tclient.edit_message_text(
                 'Akademie {} wurde gelöscht.'.format(args[1]),
                 chat_id,
                 msg_id)
     
+    @ROUTER.callback('/close_inline_keyboard')
     def _callback_close_inline_keyboard(self, chat_id, _args, update):
         """
         Handle the callback request of a /close_inline_keyboard command.
@@ -415,7 +1014,7 @@ class CountdownBot:
         Helper function to generate a textual list of academies to a given chat. If a chat_id is given, the list is sent
         to the Telegram Chat referenced by this id.
 
-        :param akademien: A list of academies to be serialized into a string.
+        :param akademien: A list of academies to be serialized into a string, in the order to be listed
         :type akademien: [dbhelper.Akademie]
         :param chat_id: A chat to send the message to
         :type chat_id: int or None
@@ -423,7 +1022,7 @@ class CountdownBot:
         """
         msg_parts = []
         
-        for a in (a for a in sorted(akademien, key=lambda x: x.name)):
+        for a in akademien:
             if a.date:
                 msg = '{} -- {}'.format(a.name, a.date.strftime('%d.%m.%Y'))
                 msg_parts.append(msg)
@@ -438,24 +1037,115 @@ class CountdownBot:
         return msg_parts
     
     def _print_akademie_countdown(self, chat_id=None, pre_text=None, post_text=None, name_filter=None):
-        akademien = [a for a in self.db.get_akademien() if a.date]
-        if name_filter:
-            akademien = [a for a in akademien if a.name == name_filter]
-            if not akademien:
+        """
+        Helper function to generate a countdown message of all academies with date. If a chat_id is given, the message
+        (and a sticker for each academy starting today) is sent to the Telegram Chat referenced by this id.
+
+        :param chat_id: A chat to send the message to
+        :type chat_id: int or None
+        :param pre_text: Text to prepend to the countdown
+        :param post_text: Text to append to the countdown
+        :param name_filter: Only include the academies with these names, in this order
+        :type name_filter: (str) or None
+        :return: The generated message or None if there is no matching academy
+        """
+        msg, sticker_list = self._render_akademie_countdown(name_filter)
+        if msg is None:
+            if name_filter:
                 self.tclient.send_message('Keine passende Akademie gefunden :\'(', chat_id)
-                return
+            else:
+                self.tclient.send_message('Es sind noch keine Akademien mit Datum eingespeichert :\'(', chat_id)
+            return None
         
-        elif not akademien:
-            self.tclient.send_message('Es sind noch keine Akademien mit Datum eingespeichert :\'(', chat_id)
-            return
+        if pre_text:
+            msg = pre_text + msg
+        if post_text:
+            msg = msg + post_text
+        if chat_id:
+            self.tclient.send_message(msg, chat_id)
+            for sticker in sticker_list:
+                self.tclient.send_sticker(sticker, chat_id)
+        
+        return msg
+    
+    def _update_live_countdown(self, chat_id):
+        """
+        Post the live countdown message of a chat or update it. The message is edited in place – and not at all, if
+        its text has not changed since the last update. If the message has been deleted, a new one is posted.
+
+        :return: The result of the request or None if the message is unchanged
+        """
+        msg, _sticker_list = self._render_akademie_countdown()
+        text = LIVE_COUNTDOWN_HEADER + (msg or 'Es sind noch keine Akademien mit Datum eingespeichert :\'(')
         
-        akademien.sort(key=lambda x: x.date)
+        live_message = self.db.get_live_message(chat_id)
+        if live_message is None:
+            return self._post_live_countdown(chat_id, text)
+        message_id, last_text = live_message
+        if text == last_text:
+            LIVE_COUNTDOWN_UPDATES.inc('unchanged')
+            return None
+        result = self.tclient.edit_message_text(text, chat_id, message_id)
+        _on_result(result, functools.partial(self._live_countdown_edited, chat_id, message_id, text))
+        return result
+    
+    def _post_live_countdown(self, chat_id, text):
+        result = self.tclient.send_message(text, chat_id)
+        _on_result(result, functools.partial(self._live_countdown_posted, chat_id, text))
+        return result
+    
+    def _live_countdown_posted(self, chat_id, text, result):
+        if not result.get('ok'):
+            return
+        LIVE_COUNTDOWN_UPDATES.inc('posted')
+        message_id = result['result']['message_id']
+        self.db.set_live_message(chat_id, message_id, text)
+        self.tclient.pin_chat_message(chat_id, message_id)
+    
+    def _live_countdown_edited(self, chat_id, message_id, text, result):
+        description = result.get('description', '')
+        if result.get('ok') or 'message is not modified' in description:
+            LIVE_COUNTDOWN_UPDATES.inc('edited')
+            self.db.set_live_message(chat_id, message_id, text)
+        elif 'message to edit not found' in description or 'message can\'t be edited' in description:
+            logger.info("Live countdown message in chat %s has been deleted, posting a new one", chat_id)
+            self._post_live_countdown(chat_id, text)
+    
+    def _render_akademie_countdown(self, name_filter=None):
+        """
+        Render the countdown message body. The result is cached for the current day and version of the academies, so
+        that sending many subscriptions only renders the message once.
+
+        :param name_filter: Only include the academies with these names, in this order
+        :type name_filter: (str) or None
+        :return: The message and a list of stickers to send afterwards. The message is None if there is no matching
+                 academy.
+        :rtype: (str or None, [str])
+        """
+        today = datetime.datetime.today().date()
+        key = (today, self.akademien.version)
+        with self._countdown_cache_lock:
+            if key != self._countdown_cache_key:
+                self._countdown_cache = {}
+                self._countdown_cache_key = key
+            
+            if name_filter not in self._countdown_cache:
+                self._countdown_cache[name_filter] = self._do_render_akademie_countdown(today, name_filter)
+            return self._countdown_cache[name_filter]
+    
+    def _do_render_akademie_countdown(self, today, name_filter):
+        akademien = self.akademien.get_akademien_by_date()
+        if name_filter:
+            by_name = {a.name: a for a in akademien}
+            akademien = [by_name[name] for name in name_filter if name in by_name]
+        if not akademien:
+            return None, []
         
         aka_list = []
         sticker_list = []
         
         for a in akademien:
-            days_left = (a.date - datetime.datetime.today().date()).days
+            days_left = (a.date - today).days
             if days_left == 1:
                 if a.name.endswith('kademie') or a.name.endswith('Aka'):
                     aka_list.append('Die {} beginnt morgen!\n\t-- <i>{}</i>\n'.format(a.name, a.description))
@@ -482,17 +1172,7 @@ class CountdownBot:
                     aka_list.append('Es sind noch {} Tage bis zur Veranstaltung {}\n\t-- <i>{}</i>\n'
                                     .format(days_left, a.name, a.description))
         
-        msg = '\n'.join(aka_list)
-        if pre_text:
-            msg = pre_text + msg
-        if post_text:
-            msg = msg + post_text
-        if chat_id:
-            self.tclient.send_message(msg, chat_id)
-            for sticker in sticker_list:
-                self.tclient.send_sticker(sticker, chat_id)
-        
-        return msg
+        return '\n'.join(aka_list), sticker_list
     
     def _too_much_spam(self, update):
         """
@@ -508,17 +1188,10 @@ class CountdownBot:
         if chat_type == "private":
             return False
         elif self._is_group(update):
-            last_msg = self.db.get_last_message_time(chat_id)
-            if not last_msg:
-                self.db.set_last_message_time(chat_id)
-                return False
-            else:
-                delta = datetime.datetime.utcnow() - datetime.datetime.strptime(last_msg[0], '%Y-%m-%d %H:%M:%S.%f')
-                if delta < self.spam_protection_time:
-                    logger.info("Too much spam in chat {}".format(chat_id))
-                    return True
-                self.db.set_last_message_time(chat_id)
-                return False
+            if self.spam_limiter.check(chat_id):
+                logger.info("Too much spam in chat %s", chat_id)
+                return True
+            return False
         else:
             return False
     
@@ -538,6 +1211,24 @@ class CountdownBot:
             return False
 
 
+def _on_result(result, callback):
+    """
+    Call a function with the result of a TClient request, as soon as it is available. Depending on the client, requests
+    return the result directly, as concurrent Future (SendQueue) or as asyncio Task (AsyncTClient). Failed requests
+    are reported by the client, so the function is only called with results.
+
+    :param callback: Function to call with the result (the API response as dict)
+    """
+    if not hasattr(result, 'add_done_callback'):
+        callback(result)
+        return
+    
+    def done(future):
+        if not future.cancelled() and future.exception() is None:
+            callback(future.result())
+    result.add_done_callback(done)
+
+
 def main():
     # Read command line arguments
     parser = argparse.ArgumentParser(description='CdE Akademie Countdown Bot')
@@ -548,45 +1239,432 @@ def main():
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help="Reduce logging level to provide more verbose log output. "
                              "(Use twice for even more verbose logging.)")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('-a', '--async', action='store_true', dest='use_async',
+                      help="Use the asyncio runtime: Poll for updates, process them and send subscriptions "
+                           "concurrently.")
+    mode.add_argument('-w', '--webhook', action='store_true',
+                      help="Receive updates via webhook instead of polling. The webhook is configured in the "
+                           "[webhook] section of the config file.")
+    mode.add_argument('-s', '--shards', type=int, metavar='N',
+                      help="Start N processes sharing the database, which split the delivery of subscriptions by "
+                           "chat. One of them polls for updates.")
+    mode.add_argument('--shard', metavar='I/N',
+                      help="Run as process I (0 <= I < N) of N processes sharing the database. Used by --shards, but "
+                           "the processes may also be started separately, e.g. on several machines with access to "
+                           "the database.")
+    mode.add_argument('--import', metavar='FILE', dest='import_file',
+                      help="Import academies and subscriptions from a CSV or JSON file and exit. Existing academies "
+                           "(by name) and subscriptions (by chat and time) are replaced.")
+    mode.add_argument('--export', metavar='FILE', dest='export_file',
+                      help="Export all academies and subscriptions to a JSON file ('-' for stdout) and exit.")
     args = parser.parse_args()
     
+    # Read configuration
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    
+    # Initialize logging
+    log_config = config['logging'] if 'logging' in config else {}
+    logsetup.setup_logging(30 - args.verbose * 10,
+                           json_format=log_config.get('format', 'text').lower() == 'json',
+                           queue_size=int(log_config.get('queue_size', 10000)))
+    
+    if args.shards:
+        run_shards(args.shards, ['-c', args.config, '-d', args.database] + ['-v'] * args.verbose)
+        return
+    shard = shard_count = None
+    if args.shard:
+        shard, shard_count = (int(x) for x in args.shard.split('/'))
+        if not 0 <= shard < shard_count:
+            parser.error("Invalid shard {}".format(args.shard))
+    
     # Setup DB
-    db = DBHelper(args.database)
+    db_config = config['database'] if 'database' in config else {}
+    db = DBHelper(args.database,
+                  write_behind=db_config.get('write_behind', 'no').lower() in ('1', 'yes', 'true', 'on'),
+                  max_batch=int(db_config.get('max_batch', 100)),
+                  max_latency=float(db_config.get('max_latency', 1)))
     db.setup()
     
-    # Initialize logging
-    logging.basicConfig(level=30 - args.verbose * 10,
-                        format="%(asctime)s [%(levelname)-8s] %(name)s - %(message)s")
+    if args.import_file or args.export_file:
+        sys.exit(run_bulk(db, args.import_file, args.export_file))
     
-    # Read configuration and setup Telegram client
-    config = configparser.ConfigParser()
-    config.read(args.config)
-    tclient = TClient(config['telegram']['token'])
+    # Setup Telegram client
+    tclient = TClient(config['telegram']['token'],
+                      pool_size=int(config['telegram'].get('pool_size', 10)),
+                      connect_timeout=float(config['telegram'].get('connect_timeout', 5)),
+                      read_timeout=float(config['telegram'].get('read_timeout', 15)),
+                      retries=int(config['telegram'].get('retries', 3)),
+                      backoff_factor=float(config['telegram'].get('backoff', 0.5)),
+                      base_url=config['telegram'].get('url', TClient.API_URL))
+    tclient = SendQueue(tclient,
+                        workers=int(config['telegram'].get('send_workers', 4)),
+                        # Telegram's global rate limit applies to all processes of the bot together
+                        global_rate=float(config['telegram'].get('rate_global', 30)) / (shard_count or 1),
+                        chat_rate=float(config['telegram'].get('rate_chat', 1)),
+                        group_rate=float(config['telegram'].get('rate_group', 20)) / 60)
     admins = [int(x) for x in config['telegram']['admins'].split()]
     spam_protection_time = datetime.timedelta(seconds=float(config['general'].get('spam_protection', 300)))
-    countdown_bot = CountdownBot(db, tclient, admins, spam_protection_time)
+    workers = int(config['general'].get('workers', 4))
+    profile_dir = config['general'].get('profile_dir', '.')
+    
+    # Setup instrumentation
+    metrics_config = config['metrics'] if 'metrics' in config else {}
+    if int(metrics_config.get('port', 0)):
+        metrics.MetricsServer(metrics_config.get('listen', '0.0.0.0'), int(metrics_config['port'])).start()
+    if float(metrics_config.get('log_interval', 0)):
+        metrics.StatsLogger(float(metrics_config['log_interval'])).start()
+    metrics.REGISTRY.gauge('send_queue_depth', 'Messages waiting in the send queue', function=lambda: tclient.depth)
+    metrics.REGISTRY.gauge('send_queue_dropped', 'Messages dropped by the send queue', function=lambda: tclient.dropped)
+    metrics.REGISTRY.gauge('send_queue_rate_limited', 'Messages rate limited by Telegram',
+                           function=lambda: tclient.rate_limited)
     
-    # Initialize subscription update interval
-    last_subscription_send = datetime.datetime.min
-    subscription_interval = datetime.timedelta(seconds=float(config['general'].get('interval_sub', 60)))
     subscription_max_age = datetime.timedelta(seconds=float(config['general'].get('max_age_sub', 1800)))
     
-    # Main loop
-    while True:
-        # Wait for Telegram updates (up to 10 seconds) and process them
-        countdown_bot.await_and_process_updates(timeout=10)
-        
-        # Send subscriptions (if subscription_interval since last check)
-        now = datetime.datetime.utcnow()
-        if (now - last_subscription_send) > subscription_interval:
+    if args.use_async:
+        atclient = AsyncTClient(tclient, max_in_flight=int(config['telegram'].get('max_in_flight', 10)))
+        countdown_bot = CountdownBot(db, atclient, admins, spam_protection_time, profile_dir=profile_dir)
+        asyncio.run(async_main_loop(countdown_bot, subscription_max_age))
+    elif args.webhook:
+        webhook_config = config['webhook']
+        webhook = WebhookServer(webhook_config.get('listen', '0.0.0.0'),
+                                int(webhook_config.get('port', 8443)),
+                                webhook_config.get('path', '/telegram'),
+                                webhook_config.get('secret'),
+                                int(webhook_config.get('max_queue', 1000)))
+        countdown_bot = CountdownBot(db, tclient, admins, spam_protection_time, workers, profile_dir)
+        webhook_loop(countdown_bot, webhook, webhook_config['url'], subscription_max_age)
+    elif args.shard:
+        countdown_bot = CountdownBot(db, tclient, admins, spam_protection_time, workers, profile_dir)
+        coordinator = ShardCoordinator(db, shard, shard_count,
+                                       lease_time=float(config['general'].get('lease_time', 30)))
+        shard_loop(countdown_bot, coordinator, subscription_max_age)
+    else:
+        countdown_bot = CountdownBot(db, tclient, admins, spam_protection_time, workers, profile_dir)
+        main_loop(countdown_bot, subscription_max_age)
+
+
+def run_bulk(db, import_file, export_file):
+    """
+    Import or export the academies and subscriptions (command line options --import and --export).
+
+    :return: The exit code
+    """
+    if export_file:
+        if export_file == '-':
+            akademien, subscriptions = bulk.export(db, sys.stdout)
+        else:
+            with open(export_file, 'w', encoding='utf-8') as f:
+                akademien, subscriptions = bulk.export(db, f)
+        logger.info("Exported %s academies and %s subscriptions", akademien, subscriptions)
+        return 0
+    
+    with open(import_file, 'rb') as f:
+        data = bulk.parse(f.read(), import_file)
+    added = updated = 0
+    if data and not data.errors:
+        added, updated = AkademieRepository(db).import_akademien(data.akademien, data.subscriptions)
+    print(bulk.summary(data, added, updated))
+    return 1 if data.errors else 0
+
+
+def main_loop(countdown_bot, subscription_max_age):
+    """
+    Synchronous main loop: Alternately poll for updates, process them and send due subscriptions.
+    """
+    countdown_bot.restore_update_offset()
+    last_subscription_send = _restore_subscription_watermark(countdown_bot, subscription_max_age)
+    countdown_bot.deliver_outbox()
+    
+    try:
+        while True:
+            countdown_bot.refresh()
+            countdown_bot.flush()
+            
+            # Wait for Telegram updates (up to 10 seconds or until the next subscription is due) and process them
+            countdown_bot.await_and_process_updates(
+                timeout=int(_time_to_next_subscription(countdown_bot, last_subscription_send)))
+            
+            last_subscription_send = _send_due_subscriptions(countdown_bot, last_subscription_send,
+                                                             subscription_max_age)
+            
+            # Sleep for half a second
+            time.sleep(0.5)
+    finally:
+        countdown_bot.stop()
+        countdown_bot.flush(force=True)
+        countdown_bot.tclient.close()
+
+
+def webhook_loop(countdown_bot, webhook, webhook_url, subscription_max_age):
+    """
+    Synchronous main loop for webhook mode: Register the webhook, then process updates received by the webhook server
+    and send due subscriptions. The webhook is deleted on exit.
+    """
+    last_subscription_send = _restore_subscription_watermark(countdown_bot, subscription_max_age)
+    countdown_bot.deliver_outbox()
+    
+    webhook.start()
+    countdown_bot.tclient.set_webhook(webhook_url, webhook.secret_token)
+    try:
+        while True:
+            countdown_bot.refresh()
+            countdown_bot.flush()
+            
+            # Wait for updates (up to 10 seconds or until the next subscription is due) and process them
+            update = webhook.get(timeout=_time_to_next_subscription(countdown_bot, last_subscription_send))
+            if update is not None:
+                countdown_bot.process_update(update)
+            
+            last_subscription_send = _send_due_subscriptions(countdown_bot, last_subscription_send,
+                                                             subscription_max_age)
+    finally:
+        countdown_bot.tclient.delete_webhook()
+        webhook.stop()
+        countdown_bot.stop()
+        countdown_bot.flush(force=True)
+        countdown_bot.tclient.close()
+
+
+def run_shards(shard_count, arguments):
+    """
+    Start `shard_count` bot processes sharing the database and restart them if they exit. On KeyboardInterrupt, the
+    processes are stopped.
+
+    :param arguments: Command line arguments for the processes (besides --shard)
+    """
+    def start(shard):
+        logger.info("Starting process for shard %s/%s", shard, shard_count)
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                 '--shard', '{}/{}'.format(shard, shard_count)] + arguments)
+    
+    processes = [start(shard) for shard in range(shard_count)]
+    try:
+        while True:
+            time.sleep(1)
+            for shard, process in enumerate(processes):
+                if process.poll() is not None:
+                    logger.error("Process of shard %s/%s exited with code %s. Restarting it.",
+                                 shard, shard_count, process.returncode)
+                    processes[shard] = start(shard)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in processes:
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def shard_loop(countdown_bot, coordinator, subscription_max_age):
+    """
+    Main loop of one of several processes sharing the database: Deliver the subscriptions of the shards held by this
+    process and, if it holds the poller lease, poll for updates and process them. The leases are released on exit.
+    """
+    polling = False
+    resumed = set()
+    try:
+        while True:
+            try:
+                coordinator.renew()
+                countdown_bot.shards = {(shard, coordinator.shard_count) for shard in coordinator.shards}
+                countdown_bot.outbox_owner = coordinator.owner
+                countdown_bot.refresh()
+                countdown_bot.flush()
+            except Exception as e:
+                # E.g. "database is locked" while another process holds the write lock for too long. Try again in the
+                # next iteration instead of giving up the shards.
+                logger.error("Error while renewing leases or refreshing the shared state:", exc_info=e)
+            
+            # Wait for Telegram updates or sleep (up to 10 seconds or until the next subscription is due)
+            now = datetime.datetime.utcnow()
+            watermarks = [coordinator.watermark(shard) or now for shard in coordinator.shards]
+            timeout = _time_to_next_subscription(countdown_bot, min(watermarks, default=now),
+                                                 min(10, coordinator.lease_time / 3))
+            if coordinator.is_poller:
+                if not polling:
+                    # Continue where the previous poller stopped
+                    countdown_bot.restore_update_offset()
+                    polling = True
+                countdown_bot.await_and_process_updates(timeout=int(timeout))
+            else:
+                polling = False
+                time.sleep(timeout)
+            
+            # Continue sending the outbox messages of newly acquired shards, which their previous owner left behind
+            try:
+                for shard in sorted(coordinator.shards - resumed):
+                    countdown_bot.deliver_outbox((shard, coordinator.shard_count))
+                resumed = set(coordinator.shards)
+            except Exception as e:
+                logger.error("Error while resuming the outbox of acquired shards:", exc_info=e)
+            for shard in sorted(coordinator.shards):
+                _send_due_shard_subscriptions(countdown_bot, coordinator, shard, subscription_max_age)
+            
+            # Sleep for half a second
+            time.sleep(0.5)
+    finally:
+        try:
+            countdown_bot.stop()
+            # Send the queued messages before releasing their shards, as their claims end with the leases
+            countdown_bot.flush(force=True)
+        finally:
+            coordinator.release()
+            countdown_bot.tclient.close()
+
+
+def _send_due_shard_subscriptions(countdown_bot, coordinator, shard, subscription_max_age):
+    """
+    Send the subscriptions of a shard, which are due since the shard's watermark, and advance the watermark.
+    """
+    interval = _next_delivery_interval(
+        countdown_bot, coordinator.watermark(shard) or datetime.datetime.utcnow() - subscription_max_age,
+        subscription_max_age)
+    if not interval:
+        return
+    
+    try:
+        sent = countdown_bot.send_subscriptions(None, interval, subscription_max_age, (shard, coordinator.shard_count))
+        logger.debug("Sent %s subscriptions of shard %s/%s", sent, shard, coordinator.shard_count)
+    except Exception as e:
+        logger.error("Error while processing Subscriptions:", exc_info=e)
+    coordinator.set_watermark(shard, interval[1])
+
+
+def _time_to_next_subscription(countdown_bot, last_subscription_send, maximum=10):
+    """
+    :return: Seconds until the next subscription is due, but at most `maximum`
+    """
+    next_subscription = countdown_bot.next_subscription_time(last_subscription_send)
+    if not next_subscription:
+        return maximum
+    delay = (next_subscription - datetime.datetime.utcnow()).total_seconds()
+    if delay <= 0 and _send_queue_depth(countdown_bot) > CATCHUP_QUEUE_LIMIT:
+        # Missed subscriptions are waiting for the send queue to drain. Don't poll for updates without a timeout
+        # meanwhile.
+        return min(maximum, CATCHUP_BACKOFF)
+    return min(maximum, max(0, delay))
+
+
+def _send_queue_depth(countdown_bot):
+    """
+    :return: Number of outbound requests waiting to be sent (0 if the Telegram client does not queue requests)
+    """
+    return getattr(countdown_bot.tclient, 'depth', 0)
+
+
+def _restore_subscription_watermark(countdown_bot, subscription_max_age):
+    """
+    :return: The time up to which subscriptions have been delivered before the last restart, but at most
+             `subscription_max_age` ago
+    """
+    oldest = datetime.datetime.utcnow() - subscription_max_age
+    watermark = countdown_bot.load_subscription_watermark()
+    if watermark and watermark > oldest:
+        logger.info("Continuing subscription delivery after %s", watermark)
+        return watermark
+    return oldest
+
+
+def _next_delivery_interval(countdown_bot, watermark, subscription_max_age):
+    """
+    Get the interval of subscriptions to send next. Usually this is the time from the watermark until now. Missed
+    subscriptions (e.g. after a downtime) are only caught up for the last `subscription_max_age` and in steps of
+    CATCHUP_STEP, each taken when the send queue has room.
+
+    :param watermark: The time up to which subscriptions have been delivered
+    :return: The interval or None if no subscription is due or the catch-up has to wait
+    :rtype: (datetime.datetime, datetime.datetime) or None
+    """
+    now = datetime.datetime.utcnow()
+    next_subscription = countdown_bot.next_subscription_time(watermark)
+    if not next_subscription or next_subscription > now:
+        return None
+    
+    start = max(watermark, now - subscription_max_age)
+    end = min(now, max(next_subscription, start + CATCHUP_STEP))
+    if end < now and _send_queue_depth(countdown_bot) > CATCHUP_QUEUE_LIMIT:
+        return None
+    return start, end
+
+
+def _send_due_subscriptions(countdown_bot, last_subscription_send, subscription_max_age):
+    """
+    Send subscriptions if one is due since the last sending of subscriptions and store the new watermark.
+
+    :return: The new time of the last sending of subscriptions
+    """
+    interval = _next_delivery_interval(countdown_bot, last_subscription_send, subscription_max_age)
+    if not interval:
+        return last_subscription_send
+    
+    try:
+        countdown_bot.send_subscriptions(None, interval, subscription_max_age)
+    except Exception as e:
+        logger.error("Error while processing Subscriptions:", exc_info=e)
+    countdown_bot.save_subscription_watermark(interval[1])
+    logger.debug("Outbound messages: %s", countdown_bot.tclient)
+    logger.debug("Database: %s", countdown_bot.db.commit_stats())
+    return interval[1]
+
+
+async def async_main_loop(countdown_bot, subscription_max_age):
+    """
+    Asynchronous main loop: Poll for and process updates and send due subscriptions in concurrent tasks. Outbound
+    messages are sent in the background by the bot's AsyncTClient.
+    """
+    async def poll_updates():
+        while True:
             try:
-                countdown_bot.send_subscriptions('1', (last_subscription_send, now), subscription_max_age)
+                countdown_bot.refresh()
+                countdown_bot.flush()
+                await countdown_bot.await_and_process_updates_async(timeout=10)
             except Exception as e:
-                logger.error("Error while processing Subscriptions:", exc_info=e)
-            last_subscription_send = now
+                logger.error("Error while polling Telegram updates:", exc_info=e)
+                await asyncio.sleep(0.5)
+    
+    async def send_subscriptions():
+        # Wake up when a subscription is due or the subscriptions have changed
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        countdown_bot.scheduler.add_listener(lambda: loop.call_soon_threadsafe(wakeup.set))
         
-        # Sleep for half a second
-        time.sleep(0.5)
+        last_subscription_send = _restore_subscription_watermark(countdown_bot, subscription_max_age)
+        countdown_bot.deliver_outbox()
+        while True:
+            now = datetime.datetime.utcnow()
+            next_subscription = countdown_bot.next_subscription_time(last_subscription_send)
+            if next_subscription and next_subscription <= now:
+                previous_send = last_subscription_send
+                last_subscription_send = _send_due_subscriptions(countdown_bot, last_subscription_send,
+                                                                 subscription_max_age)
+                if last_subscription_send == previous_send:
+                    # The catch-up is held back until the send queue has room
+                    await asyncio.sleep(CATCHUP_BACKOFF)
+                elif last_subscription_send < now:
+                    # Catching up: Let the other tasks run between the steps
+                    await asyncio.sleep(0.5)
+                continue
+            
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(),
+                                       (next_subscription - now).total_seconds() if next_subscription else None)
+            except asyncio.TimeoutError:
+                pass
+    
+    countdown_bot.restore_update_offset()
+    try:
+        await asyncio.gather(poll_updates(), send_subscriptions())
+    finally:
+        await countdown_bot.tclient.drain()
+        countdown_bot.flush(force=True)
+        await countdown_bot.tclient.close()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,33 @@
+import functools
 import logging
 import sqlite3
 import datetime
+import threading
+import time
+import metrics
+from search import TrigramIndex
 
 logger = logging.getLogger(__name__)
 
+QUERY_TIME = metrics.REGISTRY.histogram('sqlite_query_seconds', 'Duration of database operations', ('operation',))
+
+
+def synchronized(method):
+    """
+    Decorator for DBHelper methods to serialize access to the shared SQLite connection across threads. The duration of
+    each call is recorded in the sqlite_query_seconds metric.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                QUERY_TIME.observe(time.perf_counter() - start, method.__name__)
+    return wrapper
+
+
 class Akademie:
     def __init__(self, name, description="", date=""):
         self.name = name
@@ -16,54 +40,211 @@ class Akademie:
 
 
 class DBHelper:
-    def __init__(self, dbname="akademien.sqlite"):
+    # Schema migrations. The n-th entry upgrades the schema from version n-1 to version n. The current version is
+    # stored in SQLite's user_version. Migrations must work on databases created before versioning was introduced.
+    MIGRATIONS = [
+        # 1: Initial schema
+        [
+            "CREATE TABLE IF NOT EXISTS akademien(name text, description text, date text)",
+            "CREATE INDEX IF NOT EXISTS akademieName ON akademien (name ASC)",
+            "CREATE TABLE IF NOT EXISTS chats (chatID text, lastMessage text)",
+            "CREATE TABLE IF NOT EXISTS subscribers (chatID text, subscriptions text, time text)",
+        ],
+        # 2: Unique keys for chats and subscriptions (removing existing duplicates) and index for subscription lookup
+        [
+            "DELETE FROM chats WHERE rowid NOT IN (SELECT MAX(rowid) FROM chats GROUP BY chatID)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS chatsChatID ON chats (chatID)",
+            "DELETE FROM subscribers WHERE rowid NOT IN (SELECT MIN(rowid) FROM subscribers GROUP BY chatID, time)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS subscribersChatTime ON subscribers (chatID, time)",
+            "CREATE INDEX IF NOT EXISTS subscribersSubscriptionsTime ON subscribers (subscriptions, time)",
+        ],
+        # 3: Leases to coordinate several processes sharing the database, with the subscription delivery watermark of
+        # each shard
+        [
+            "CREATE TABLE IF NOT EXISTS leases (name text PRIMARY KEY, owner text, expires real, watermark text)",
+        ],
+        # 4: Key-value store for state surviving restarts (e.g. the update offset)
+        [
+            "CREATE TABLE IF NOT EXISTS state (key text PRIMARY KEY, value text)",
+        ],
+        # 5: Live countdown messages, which are edited instead of sending new messages, with their last text
+        [
+            "CREATE TABLE IF NOT EXISTS live_messages (chatID text PRIMARY KEY, messageID integer, text text)",
+        ],
+        # 6: Unique academy names (keeping the latest of duplicates), so that imports can upsert academies by name
+        [
+            "DELETE FROM akademien WHERE rowid NOT IN (SELECT MAX(rowid) FROM akademien GROUP BY name)",
+            "DROP INDEX IF EXISTS akademieName",
+            "CREATE UNIQUE INDEX IF NOT EXISTS akademienName ON akademien (name)",
+        ],
+        # 7: Outbox of subscription messages, so that an interrupted fan-out can be resumed
+        [
+            "CREATE TABLE IF NOT EXISTS outbox (key text PRIMARY KEY, chatID text, subscriptions text, time text, "
+            "due real, state integer DEFAULT 0)",
+            "CREATE INDEX IF NOT EXISTS outboxStateDue ON outbox (state, due, key)",
+        ],
+        # 8: Change counter of the subscriptions, bumped by triggers on every write (including type changes, chat
+        # migrations and imports), so that other processes notice changes cheaply
+        [
+            "INSERT OR IGNORE INTO state (key, value) VALUES ('subscriptions_version', '0')",
+            "CREATE TRIGGER IF NOT EXISTS subscribersInserted AFTER INSERT ON subscribers BEGIN "
+            "UPDATE state SET value = value + 1 WHERE key = 'subscriptions_version'; END",
+            "CREATE TRIGGER IF NOT EXISTS subscribersUpdated AFTER UPDATE ON subscribers BEGIN "
+            "UPDATE state SET value = value + 1 WHERE key = 'subscriptions_version'; END",
+            "CREATE TRIGGER IF NOT EXISTS subscribersDeleted AFTER DELETE ON subscribers BEGIN "
+            "UPDATE state SET value = value + 1 WHERE key = 'subscriptions_version'; END",
+        ],
+        # 9: Retries of outbox messages which failed temporarily
+        [
+            "ALTER TABLE outbox ADD COLUMN attempts integer DEFAULT 0",
+            "ALTER TABLE outbox ADD COLUMN not_before real DEFAULT 0",
+        ],
+        # 10: Claims of outbox messages by the process sending them (see claim_outbox())
+        [
+            "ALTER TABLE outbox ADD COLUMN claimed_by text",
+        ],
+    ]
+
+    def __init__(self, dbname="akademien.sqlite", write_behind=False, max_batch=100, max_latency=1.0):
+        """
+        :param dbname: Path of the SQLite database
+        :param write_behind: If True, changes are not committed immediately but collected and committed together
+                             (group commit), when `max_batch` changes are pending or the oldest pending change is
+                             older than `max_latency` seconds. Use `flush()` to commit pending changes immediately.
+        :param max_batch: Maximum number of changes per group commit
+        :param max_latency: Maximum time (in seconds) a change may remain uncommitted. Pending changes are committed
+                            by a timer when it has passed, as the open write transaction locks out other connections
+                            (e.g. other processes) until the commit.
+        """
         self.dbname = dbname
-        self.c = sqlite3.connect(dbname)
+        self.write_behind = write_behind
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.commits = 0
+        self.committed_rows = 0
+        self._pending_changes = 0
+        self._first_pending = None
+        self._total_changes = 0
+        # The connection is shared by all threads, access is serialized by the @synchronized methods
+        self._lock = threading.RLock()
+        self.c = sqlite3.connect(dbname, check_same_thread=False)
+        # Write-ahead logging lets readers proceed during writes and only needs a sync at checkpoints with
+        # synchronous=NORMAL
+        self.c.execute("PRAGMA journal_mode = WAL")
+        self.c.execute("PRAGMA synchronous = NORMAL")
+        self.c.execute("PRAGMA cache_size = -8000")
+        self.c.execute("PRAGMA temp_store = MEMORY")
+        self.c.execute("PRAGMA busy_timeout = 5000")
 
+    @synchronized
     def setup(self):
-        q = "CREATE TABLE IF NOT EXISTS akademien(name text, description text, date text)"
-        self.c.execute(q)
-        q = "CREATE INDEX IF NOT EXISTS akademieName ON akademien (name ASC)"
-        self.c.execute(q)
-        q = "CREATE TABLE IF NOT EXISTS chats (chatID text, lastMessage text)"
-        self.c.execute(q)
-        q = "CREATE TABLE IF NOT EXISTS subscribers (chatID text, subscriptions text, time text)"
-        self.c.execute(q)
+        """
+        Create the database schema or upgrade it to the current version
+        """
+        version = self.get_schema_version()
+        for target_version, migration in enumerate(self.MIGRATIONS[version:], version + 1):
+            self.c.execute("BEGIN")
+            try:
+                for q in migration:
+                    self.c.execute(q)
+                self.c.execute("PRAGMA user_version = {:d}".format(target_version))
+                self.c.commit()
+            except Exception:
+                self.c.rollback()
+                raise
+            logger.info("Upgraded database schema to version %s", target_version)
+        self._total_changes = self.c.total_changes
+
+    @synchronized
+    def get_schema_version(self):
+        return self.c.execute("PRAGMA user_version").fetchone()[0]
+
+    @synchronized
+    def flush(self):
+        """
+        Commit all pending changes immediately (flush barrier for write-behind mode).
+        """
+        if self._pending_changes:
+            self._do_commit()
+
+    @synchronized
+    def maybe_flush(self):
+        """
+        Commit pending changes if the oldest one has exceeded the maximum latency. In write-behind mode, this should be
+        called regularly.
+        """
+        if self._pending_changes and time.monotonic() - self._first_pending >= self.max_latency:
+            self._do_commit()
+
+    def commit_stats(self):
+        return "{} commits, {:.1f} rows per commit, {} changes pending".format(
+            self.commits, self.committed_rows / self.commits if self.commits else 0, self._pending_changes)
+
+    def _commit(self, durable=False):
+        """
+        Commit a change. In write-behind mode, the commit is deferred, unless it is `durable` or the batch is full.
+        """
+        if not self.write_behind or durable:
+            self._do_commit()
+            return
+        if not self._pending_changes:
+            self._first_pending = time.monotonic()
+            timer = threading.Timer(self.max_latency, self._flush_batch, (self._first_pending,))
+            timer.daemon = True
+            timer.start()
+        self._pending_changes += 1
+        if self._pending_changes >= self.max_batch or time.monotonic() - self._first_pending >= self.max_latency:
+            self._do_commit()
+
+    @synchronized
+    def _flush_batch(self, first_pending):
+        """
+        Commit the batch of pending changes started at `first_pending`, unless it has been committed already.
+        """
+        if self._pending_changes and self._first_pending == first_pending:
+            self._do_commit()
+
+    def _do_commit(self):
         self.c.commit()
+        self.commits += 1
+        self.committed_rows += self.c.total_changes - self._total_changes
+        self._total_changes = self.c.total_changes
+        self._pending_changes = 0
+        self._first_pending = None
 
+    @synchronized
     def add_akademie(self, name, description="", date=""):
         q = "INSERT INTO akademien (name, description, date) VALUES (?, ?, ?)"
         args = (name, description, date)
         self.c.execute(q, args)
-        self.c.commit()
-        logger.info("Created new academy '{}' at {}".format(name, date))
+        self._commit(durable=True)
+        logger.info("Created new academy '%s' at %s", name, date)
 
+    @synchronized
     def delete_akademie(self, name):
         q = "DELETE FROM akademien WHERE name = (?)"
         args = (name,)
         self.c.execute(q, args)
-        self.c.commit()
-        logger.info("Deleted academy '{}'".format(name))
+        self._commit(durable=True)
+        logger.info("Deleted academy '%s'", name)
 
+    @synchronized
     def edit_akademie(self, name, new_name, new_description, new_date):
-        if not self.c.execute("SELECT * FROM akademien WHERE name = ?", (name, )).fetchone(): 
-            print('Keine Akademie unter diesem Namen gefunden.')
-            return
-        if new_date != '':
-            q = "UPDATE akademien SET date = ? WHERE name = ?"
-            args = (new_date, name)
-            self.c.execute(q, args)
-        if new_description != '':
-            q = "UPDATE akademien SET description = ? WHERE name = ?"
-            args = (new_description, name)
-            self.c.execute(q, args)
-        if new_name != '':
-            q = "UPDATE akademien SET name = ? WHERE name = ?"
-            args = (new_name, name)
-            self.c.execute(q, args)
-        self.c.commit()
-        logger.info("Edited academy '{}'".format(name))
+        # Empty values leave the field unchanged
+        q = "UPDATE akademien SET date = COALESCE(NULLIF(?, ''), date), " \
+            "description = COALESCE(NULLIF(?, ''), description), name = COALESCE(NULLIF(?, ''), name) " \
+            "WHERE name = ?"
+        args = (new_date, new_description, new_name, name)
+        try:
+            found = self.c.execute(q, args).rowcount > 0
+        finally:
+            # End the transaction on every path, a failed statement does not roll back the pending changes
+            self._commit(durable=True)
+        if found:
+            logger.info("Edited academy '%s'", name)
+        return found
 
+    @synchronized
     def get_akademien(self):
         q = "SELECT name, description, date FROM akademien"
         result = []
@@ -71,6 +252,65 @@ class DBHelper:
             result.append(Akademie(row[0], row[1], row[2]))
         return result
 
+    @synchronized
+    def import_data(self, akademien, subscriptions):
+        """
+        Insert or replace many academies (by name) and subscriptions (by chat and time) in a single transaction.
+
+        :param akademien: (name, description, date) tuples
+        :type akademien: [(str, str, str)]
+        :param subscriptions: (chat_id, subscriptions, time) tuples
+        :type subscriptions: [(str, str, str)]
+        """
+        # Commit pending write-behind changes first, so that a rollback only discards the import
+        if self._pending_changes:
+            self._do_commit()
+        try:
+            self.c.executemany("INSERT INTO akademien (name, description, date) VALUES (?, ?, ?) "
+                               "ON CONFLICT (name) DO UPDATE SET description = excluded.description, "
+                               "date = excluded.date", akademien)
+            self.c.executemany("INSERT INTO subscribers (chatID, subscriptions, time) VALUES (?, ?, ?) "
+                               "ON CONFLICT (chatID, time) DO UPDATE SET subscriptions = excluded.subscriptions",
+                               subscriptions)
+        except Exception:
+            self.c.rollback()
+            raise
+        self._commit(durable=True)
+        logger.info("Imported %s academies and %s subscriptions", len(akademien), len(subscriptions))
+
+    def iter_akademien(self):
+        """
+        Iterate over all academies as (name, description, date) rows, without loading all of them at once.
+        """
+        return self._iter("SELECT name, description, date FROM akademien ORDER BY name")
+
+    def iter_subscriptions(self):
+        """
+        Iterate over all subscriptions as (chat_id, subscriptions, time) rows, without loading all of them at once.
+        """
+        return self._iter("SELECT chatID, subscriptions, time FROM subscribers ORDER BY chatID, time")
+
+    def _iter(self, q, batch_size=500):
+        cursor = self.c.cursor()
+        with self._lock:
+            cursor.execute(q)
+        while True:
+            # Only hold the lock while fetching a batch, so that other threads can use the connection in between
+            with self._lock:
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+
+    @synchronized
+    def get_data_version(self):
+        """
+        Get SQLite's data version, which changes whenever another connection (e.g. another process) commits a change
+        to the database file.
+        """
+        return self.c.execute("PRAGMA data_version").fetchone()[0]
+
+    @synchronized
     def get_last_message_time(self, chat_id):
         q = "SELECT lastMessage FROM chats WHERE chatID = ?"
         args = (chat_id,)
@@ -78,28 +318,45 @@ class DBHelper:
 
         return result
 
+    @synchronized
     def set_last_message_time(self, chat_id):
-        if not self.get_last_message_time(chat_id):
-            q = "INSERT INTO chats (lastMessage, chatID) VALUES (?, ?)"
-        else:
-            q = "UPDATE chats SET lastMessage = ? WHERE chatID = ?"
+        q = "INSERT INTO chats (lastMessage, chatID) VALUES (?, ?) " \
+            "ON CONFLICT (chatID) DO UPDATE SET lastMessage = excluded.lastMessage"
         args = (datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f'), chat_id)
         self.c.execute(q, args)
-        self.c.commit()
+        self._commit()
 
+    @synchronized
+    def get_last_message_times(self):
+        q = "SELECT chatID, lastMessage FROM chats"
+        return [x for x in self.c.execute(q)]
+
+    @synchronized
+    def set_last_message_times(self, last_messages):
+        """
+        Store the last message times of multiple chats in a single transaction.
+
+        :param last_messages: (chat_id, last message time) pairs
+        :type last_messages: [(int or str, str)]
+        """
+        q = "INSERT INTO chats (chatID, lastMessage) VALUES (?, ?) " \
+            "ON CONFLICT (chatID) DO UPDATE SET lastMessage = excluded.lastMessage"
+        self.c.executemany(q, last_messages)
+        self._commit()
+
+    @synchronized
     def add_subcription(self, chat_id, subscriptions, time='06:00:00'):
-        
-        if not self.c.execute("SELECT subscriptions FROM subscribers WHERE chatID = ? AND time = ?",
-                              (chat_id, time))\
-                .fetchone():
-            q = "INSERT INTO subscribers (chatID, subscriptions, time) VALUES (?, ?, ?)"
-            args = (chat_id, subscriptions, time)
-            self.c.execute(q, args)
-            self.c.commit()
-            logger.info("Added subscription for {} at {}".format(chat_id, time))
+        q = "INSERT INTO subscribers (chatID, subscriptions, time) VALUES (?, ?, ?) " \
+            "ON CONFLICT (chatID, time) DO NOTHING"
+        args = (chat_id, subscriptions, time)
+        inserted = self.c.execute(q, args).rowcount
+        self._commit()
+        if inserted:
+            logger.info("Added subscription for %s at %s", chat_id, time)
         else:
-            logger.warning("Chat {} has already a subscription for {}".format(chat_id, time))
+            logger.warning("Chat %s has already a subscription for %s", chat_id, time)
 
+    @synchronized
     def remove_subscription(self, chat_id, time=None):
         if time:
             q = "DELETE FROM subscribers WHERE chatID = ? and time = ?"
@@ -108,10 +365,392 @@ class DBHelper:
             q = "DELETE FROM subscribers WHERE chatID = ?"
             args = (chat_id,)
         self.c.execute(q, args)
-        self.c.commit()
-        logger.info("Removed subscriptions of {}{}".format(chat_id, " at {}".format(time) if time else ""))
+        self._commit()
+        logger.info("Removed subscriptions of %s%s", chat_id, " at {}".format(time) if time else "")
+
+    @synchronized
+    def prune_chat(self, chat_id):
+        """
+        Remove a chat the bot can't send to anymore: its subscriptions, last message time, live countdown message and
+        pending outbox messages, in a single transaction.
 
+        :return: The number of removed subscriptions
+        """
+        removed = self.c.execute("DELETE FROM subscribers WHERE chatID = ?", (chat_id,)).rowcount
+        self.c.execute("DELETE FROM chats WHERE chatID = ?", (chat_id,))
+        self.c.execute("DELETE FROM live_messages WHERE chatID = ?", (chat_id,))
+        self.c.execute("DELETE FROM outbox WHERE chatID = ? AND state = 0", (chat_id,))
+        self._commit(durable=True)
+        logger.info("Pruned chat %s with %s subscriptions", chat_id, removed)
+        return removed
+
+    @synchronized
+    def migrate_chat(self, chat_id, new_chat_id):
+        """
+        Move the subscriptions, last message time and pending outbox messages of a group to the supergroup it has
+        been upgraded to. Entries already existing for the new chat are kept.
+
+        :return: The number of moved subscriptions
+        """
+        moved = self.c.execute("UPDATE OR IGNORE subscribers SET chatID = ? WHERE chatID = ?",
+                               (new_chat_id, chat_id)).rowcount
+        self.c.execute("UPDATE OR IGNORE chats SET chatID = ? WHERE chatID = ?", (new_chat_id, chat_id))
+        # The outbox keys start with the chat id
+        self.c.execute("UPDATE OR IGNORE outbox SET chatID = ?, key = ? || substr(key, ?) "
+                       "WHERE chatID = ? AND state = 0",
+                       (new_chat_id, str(new_chat_id), len(str(chat_id)) + 1, chat_id))
+        for table in ('subscribers', 'chats', 'outbox'):
+            self.c.execute("DELETE FROM {} WHERE chatID = ?".format(table), (chat_id,))
+        # Messages of the old group can't be edited anymore
+        self.c.execute("DELETE FROM live_messages WHERE chatID = ?", (chat_id,))
+        self._commit(durable=True)
+        logger.info("Migrated chat %s to %s with %s subscriptions", chat_id, new_chat_id, moved)
+        return moved
+
+    @synchronized
+    def get_subscription_type(self, chat_id, time):
+        """
+        :return: The type of the chat's subscription at the given time or None
+        :rtype: str or None
+        """
+        q = "SELECT subscriptions FROM subscribers WHERE chatID = ? and time = ?"
+        row = self.c.execute(q, (chat_id, time)).fetchone()
+        return row[0] if row else None
+
+    @synchronized
     def get_subscriptions(self, subscriptions):
         q = "SELECT chatID, time FROM subscribers WHERE subscriptions = ?"
         args = (subscriptions,)
         return [s for s in self.c.execute(q, args)]
+
+    @synchronized
+    def get_all_subscriptions(self):
+        q = "SELECT chatID, subscriptions, time FROM subscribers"
+        return [s for s in self.c.execute(q)]
+
+    @synchronized
+    def get_live_message(self, chat_id):
+        """
+        :return: The message id and the last text of the chat's live countdown message or None
+        :rtype: (int, str) or None
+        """
+        q = "SELECT messageID, text FROM live_messages WHERE chatID = ?"
+        return self.c.execute(q, (chat_id,)).fetchone()
+
+    @synchronized
+    def set_live_message(self, chat_id, message_id, text):
+        q = "INSERT INTO live_messages (chatID, messageID, text) VALUES (?, ?, ?) " \
+            "ON CONFLICT (chatID) DO UPDATE SET messageID = excluded.messageID, text = excluded.text"
+        self.c.execute(q, (chat_id, message_id, text))
+        self._commit()
+
+    @synchronized
+    def remove_live_message(self, chat_id):
+        self.c.execute("DELETE FROM live_messages WHERE chatID = ?", (chat_id,))
+        self._commit()
+
+    @synchronized
+    def enqueue_outbox(self, entries, retention=2 * 86400):
+        """
+        Add messages to the outbox in a single transaction. Messages with a key which is already in the outbox
+        (pending or done) are skipped. Done messages are kept for `retention` seconds to detect repeated messages.
+
+        :param entries: (key, chat_id, subscriptions, time, due) tuples. `due` is the time the message is due (as
+                        returned by time.time()).
+        :return: The number of added messages
+        """
+        q = "INSERT INTO outbox (key, chatID, subscriptions, time, due) VALUES (?, ?, ?, ?, ?) " \
+            "ON CONFLICT (key) DO NOTHING"
+        added = self.c.executemany(q, entries).rowcount
+        self.c.execute("DELETE FROM outbox WHERE state != 0 AND due < ?", (time.time() - retention,))
+        self._commit(durable=True)
+        return added
+
+    @synchronized
+    def get_pending_outbox(self, limit, after=None):
+        """
+        Get pending outbox messages, ordered by the time they are due. Messages waiting for a retry are skipped until
+        their retry time.
+
+        :param after: Only return messages after this (due, key) pair, to continue with the next batch
+        :return: (key, chat_id, subscriptions, time, due, attempts) tuples
+        """
+        if after:
+            q = "SELECT key, chatID, subscriptions, time, due, attempts FROM outbox " \
+                "WHERE state = 0 AND (due, key) > (?, ?) AND not_before <= ? ORDER BY due, key LIMIT ?"
+            args = (after[0], after[1], time.time(), limit)
+        else:
+            q = "SELECT key, chatID, subscriptions, time, due, attempts FROM outbox " \
+                "WHERE state = 0 AND not_before <= ? ORDER BY due, key LIMIT ?"
+            args = (time.time(), limit)
+        return self.c.execute(q, args).fetchall()
+
+    @synchronized
+    def claim_outbox(self, keys, owner):
+        """
+        Claim pending outbox messages for sending them, in a single transaction. Messages claimed by another process,
+        which still holds a lease (see acquire_lease()), are skipped, so that a message queued by a process is not
+        sent again by another process, which has taken over the message's shard in the meantime. Claims are released
+        by mark_outbox().
+
+        :param keys: Keys of the messages to claim
+        :param owner: Unique identifier of the claiming process, as used for its leases
+        :return: The keys of the claimed messages
+        :rtype: [str]
+        """
+        q = "UPDATE outbox SET claimed_by = ? WHERE key = ? AND state = 0 AND (claimed_by IS NULL " \
+            "OR claimed_by = ? OR NOT EXISTS (SELECT 1 FROM leases WHERE owner = claimed_by AND expires >= ?))"
+        now = time.time()
+        claimed = [key for key in keys if self.c.execute(q, (owner, key, owner, now)).rowcount > 0]
+        self._commit(durable=True)
+        return claimed
+
+    @synchronized
+    def mark_outbox(self, states, retries=()):
+        """
+        Mark outbox messages as done or to be retried and release their claims in a single transaction.
+
+        :param states: (state, key) pairs of done messages, with state != 0
+        :param retries: (not_before, key) pairs of messages to send again after `not_before` (as returned by
+                        time.time())
+        """
+        self.c.executemany("UPDATE outbox SET state = ?, claimed_by = NULL WHERE key = ?", states)
+        self.c.executemany("UPDATE outbox SET attempts = attempts + 1, not_before = ?, claimed_by = NULL "
+                           "WHERE key = ?", retries)
+        self._commit(durable=True)
+
+    @synchronized
+    def get_outbox_stats(self):
+        """
+        :return: The number of pending outbox messages and the time the oldest of them has been due (or None)
+        :rtype: (int, float or None)
+        """
+        return self.c.execute("SELECT COUNT(*), MIN(due) FROM outbox WHERE state = 0").fetchone()
+
+    @synchronized
+    def get_state(self, key):
+        """
+        :return: The stored value of the given key or None
+        :rtype: str or None
+        """
+        row = self.c.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @synchronized
+    def set_state(self, key, value, durable=False):
+        """
+        Store a value to be restored after a restart.
+
+        :param durable: Commit immediately, even in write-behind mode
+        """
+        q = "INSERT INTO state (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value"
+        self.c.execute(q, (key, str(value)))
+        self._commit(durable)
+
+    @synchronized
+    def get_subscriptions_signature(self):
+        """
+        Get a cheap signature of the subscriptions table, which changes whenever a subscription is added, changed or
+        removed.
+        """
+        return self.get_state('subscriptions_version')
+
+    @synchronized
+    def acquire_lease(self, name, owner, duration, grace=0):
+        """
+        Acquire or renew a lease. The lease is granted if it is free, held by the same owner and not expired yet or
+        expired for more than `grace` seconds.
+
+        :param name: Name of the lease
+        :param owner: Unique identifier of the acquiring process
+        :param duration: Time (in seconds) until the lease expires if it is not renewed
+        :param grace: Time (in seconds) an expired lease remains reserved for its previous owner
+        :return: True if the lease is held by `owner` now
+        """
+        now = time.time()
+        q = "INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) " \
+            "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires " \
+            "WHERE (leases.owner = excluded.owner AND leases.expires >= ?) OR leases.expires < ?"
+        acquired = self.c.execute(q, (name, owner, now + duration, now, now - grace)).rowcount > 0
+        self._commit(durable=True)
+        return acquired
+
+    @synchronized
+    def release_lease(self, name, owner):
+        q = "UPDATE leases SET expires = 0 WHERE name = ? AND owner = ?"
+        self.c.execute(q, (name, owner))
+        self._commit(durable=True)
+
+    @synchronized
+    def get_lease_watermark(self, name):
+        """
+        :return: The watermark stored with the lease or None
+        :rtype: str or None
+        """
+        row = self.c.execute("SELECT watermark FROM leases WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    @synchronized
+    def set_lease_watermark(self, name, owner, watermark):
+        """
+        Store a watermark with a lease, if the lease is still held by `owner`.
+
+        :return: True if the watermark has been stored
+        """
+        q = "UPDATE leases SET watermark = ? WHERE name = ? AND owner = ?"
+        stored = self.c.execute(q, (watermark, name, owner)).rowcount > 0
+        self._commit(durable=True)
+        return stored
+
+
+class AkademieRepository:
+    """
+    In-memory store of all academies on top of a DBHelper. The academies are loaded once and kept sorted by name and
+    by date. Reads are served from memory, changes are written through to the database.
+    """
+    def __init__(self, db):
+        """
+        :param db: The database to load the academies from and write changes to
+        :type db: DBHelper
+        """
+        self.db = db
+        # Incremented on every change, so that derived data (like rendered messages) can be invalidated
+        self.version = 0
+        self._lock = threading.RLock()
+        self._by_name = ()
+        self._by_date = ()
+        self._index = TrigramIndex((), lambda a: a.name)
+        self._data_version = None
+        # (name, description, date) of all academies, to detect whether a reload changed anything
+        self._signature = None
+        self.load()
+
+    def load(self):
+        """
+        (Re)load all academies from the database.
+
+        :return: True if the academies have changed
+        """
+        with self._lock:
+            self._data_version = self.db.get_data_version()
+            changed = self._set(self.db.get_akademien())
+        if changed:
+            logger.info("Loaded %s academies", len(self._by_name))
+        return changed
+
+    def refresh_if_changed(self):
+        """
+        Reload the academies if the database has been changed by another connection, e.g. by an external edit of the
+        database file.
+
+        :return: True if the academies have been reloaded and have changed
+        """
+        if self.db.get_data_version() == self._data_version:
+            return False
+        return self.load()
+
+    def get_akademien(self):
+        """
+        :return: All academies, sorted by name
+        :rtype: [Akademie]
+        """
+        return list(self._by_name)
+
+    def get_akademien_by_date(self):
+        """
+        :return: All academies with a valid date, sorted by date
+        :rtype: [Akademie]
+        """
+        return list(self._by_date)
+
+    def get_akademie(self, name):
+        """
+        :return: The academy with the given name or None
+        :rtype: Akademie or None
+        """
+        for a in self._by_name:
+            if a.name == name:
+                return a
+        return None
+
+    def search(self, query, limit=None):
+        """
+        Case-insensitive substring and fuzzy search by name. The matches are ranked by the quality of the match (exact,
+        word beginning, substring, fuzzy), then by date: upcoming academies (soonest first), past academies (latest
+        first) and academies without date.
+
+        :param query: The (unescaped) search text
+        :param limit: Maximum number of results
+        :return: The matching academies, best match first
+        :rtype: [Akademie]
+        """
+        today = datetime.date.today()
+
+        def rank(match):
+            score, a = match
+            if a.date is None:
+                return -score, 2, 0
+            if a.date >= today:
+                return -score, 0, (a.date - today).days
+            return -score, 1, (today - a.date).days
+
+        matches = sorted(self._index.search(query), key=rank)
+        return [a for _score, a in matches[:limit]]
+
+    def add_akademie(self, name, description="", date=""):
+        with self._lock:
+            self.db.add_akademie(name, description, date)
+            self._set(self._by_name + (Akademie(name, description, date),))
+
+    def import_akademien(self, akademien, subscriptions=()):
+        """
+        Insert or replace many academies (and subscriptions) at once, see `DBHelper.import_data()`.
+
+        :return: The number of added and of replaced academies
+        :rtype: (int, int)
+        """
+        with self._lock:
+            existing = {a.name for a in self._by_name}
+            self.db.import_data(akademien, subscriptions)
+            self.load()
+        updated = sum(1 for a in akademien if a[0] in existing)
+        return len(akademien) - updated, updated
+
+    def delete_akademie(self, name):
+        with self._lock:
+            self.db.delete_akademie(name)
+            self._set(a for a in self._by_name if a.name != name)
+
+    def edit_akademie(self, name, new_name, new_description, new_date):
+        """
+        Change an academy. Empty values leave the field unchanged.
+
+        :return: False if there is no academy with the given name
+        :rtype: bool
+        """
+        with self._lock:
+            if not self.db.edit_akademie(name, new_name, new_description, new_date):
+                return False
+            akademien = []
+            for a in self._by_name:
+                if a.name == name:
+                    a = Akademie(new_name or a.name,
+                                 new_description or a.description,
+                                 new_date or (a.date.strftime("%Y-%m-%d") if a.date else ""))
+                akademien.append(a)
+            self._set(akademien)
+        return True
+
+    def _set(self, akademien):
+        by_name = tuple(sorted(akademien, key=lambda a: a.name))
+        signature = tuple((a.name, a.description, a.date) for a in by_name)
+        if signature == self._signature:
+            # Keep the version, so that the index and the caches depending on it are not rebuilt for nothing (e.g. when
+            # another process changed the database, but not the academies)
+            return False
+        self._signature = signature
+        self._by_name = by_name
+        self._by_date = tuple(sorted((a for a in by_name if a.date), key=lambda a: a.date))
+        self._index = TrigramIndex(self._by_name, lambda a: a.name)
+        self.version += 1
+        return True
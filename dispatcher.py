@@ -0,0 +1,106 @@
+import collections
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    """
+    Worker pool for processing Telegram updates concurrently. Updates from different chats are processed in parallel,
+    while updates from the same chat are processed strictly in the order of their submission.
+    """
+    def __init__(self, process, workers=4, max_pending=1000):
+        """
+        :param process: Function to process a single update. Must be thread safe.
+        :type process: (dict) -> None
+        :param workers: Number of worker threads
+        :param max_pending: Maximum number of submitted but unfinished updates. `submit()` blocks if this number is
+                            reached.
+        """
+        self.process = process
+        self.max_pending = max_pending
+        self.pending = 0
+        # chat key -> deque of updates. The update at the head is being processed or waiting for a worker.
+        self._chats = {}
+        # chat keys with an update waiting for a worker
+        self._ready = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._workers = [threading.Thread(target=self._work, name='dispatcher-{}'.format(i), daemon=True)
+                         for i in range(workers)]
+        for w in self._workers:
+            w.start()
+
+    def submit(self, update):
+        """
+        Enqueue an update for processing. Blocks while `max_pending` updates are unfinished.
+        """
+        key = self.chat_key(update)
+        with self._cond:
+            self._cond.wait_for(lambda: self.pending < self.max_pending)
+            self.pending += 1
+            if key in self._chats:
+                self._chats[key].append(update)
+            else:
+                self._chats[key] = collections.deque((update,))
+                self._ready.append(key)
+                self._cond.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Wait until all submitted updates have been processed.
+
+        :return: True if all updates have been processed, False on timeout
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self.pending == 0, timeout)
+
+    def close(self, timeout=30):
+        """
+        Process remaining updates (waiting up to `timeout` seconds) and stop the worker threads.
+        """
+        self.join(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for w in self._workers:
+            w.join(1)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._ready or self._closed)
+                if not self._ready:
+                    return
+                key = self._ready.popleft()
+                update = self._chats[key][0]
+
+            try:
+                self.process(update)
+            except Exception as e:
+                logger.error("Error while processing a Telegram update:", exc_info=e)
+
+            with self._cond:
+                self._chats[key].popleft()
+                if self._chats[key]:
+                    self._ready.append(key)
+                else:
+                    del self._chats[key]
+                self.pending -= 1
+                self._cond.notify_all()
+
+    @staticmethod
+    def chat_key(update):
+        """
+        Get the key to order updates by: The chat id for messages and callback queries, the user id for other updates
+        with a sender and the update id otherwise.
+        """
+        if "message" in update:
+            return update["message"]["chat"]["id"]
+        if "callback_query" in update and "message" in update["callback_query"]:
+            return update["callback_query"]["message"]["chat"]["id"]
+        for value in update.values():
+            if isinstance(value, dict) and "from" in value:
+                return value["from"]["id"]
+        return ('update', update.get("update_id"))
@@ -0,0 +1,93 @@
+import bisect
+import datetime
+import html
+import logging
+import threading
+from search import normalize
+
+logger = logging.getLogger(__name__)
+
+
+class InlineResultCache:
+    """
+    Precomputed answers to inline queries: An InlineQueryResultArticle for each upcoming academy and a prefix index over
+    the words of the academy names. Both are rebuilt when the academies change or the day rolls over, so answering an
+    inline query only costs a few binary searches, without database queries or rendering.
+    """
+    MAX_RESULTS = 50
+
+    def __init__(self, akademien, render):
+        """
+        :param akademien: The academies to answer queries about
+        :type akademien: dbhelper.AkademieRepository
+        :param render: Function rendering the countdown message (HTML) of a single academy
+        :type render: (dbhelper.Akademie) -> str or None
+        """
+        self.akademien = akademien
+        self.render = render
+        self._key = None
+        self._results = []
+        # Sorted (word prefix, position in self._results) pairs
+        self._index = []
+        self._lock = threading.Lock()
+
+    def answer(self, query):
+        """
+        Get the results for an inline query. Every word of the query has to be the beginning of a word of the
+        academy's name (case insensitive). An empty query matches all upcoming academies.
+
+        :param query: The query text typed by the user
+        :type query: str
+        :return: Up to MAX_RESULTS InlineQueryResultArticle objects, ordered by date
+        :rtype: [dict]
+        """
+        results, index = self._get()
+        words = normalize(query).split()
+        if not words:
+            return results[:self.MAX_RESULTS]
+
+        matches = None
+        for word in words:
+            positions = set()
+            i = bisect.bisect_left(index, (word,))
+            while i < len(index) and index[i][0].startswith(word):
+                positions.add(index[i][1])
+                i += 1
+            matches = positions if matches is None else matches & positions
+            if not matches:
+                return []
+        return [results[i] for i in sorted(matches)[:self.MAX_RESULTS]]
+
+    def _get(self):
+        key = (datetime.datetime.today().date(), self.akademien.version)
+        with self._lock:
+            if key != self._key:
+                self._build(key[0])
+                self._key = key
+            return self._results, self._index
+
+    def _build(self, today):
+        results = []
+        index = []
+        for a in self.akademien.get_akademien_by_date():
+            if a.date < today:
+                continue
+            text = self.render(a)
+            if not text:
+                continue
+            days_left = (a.date - today).days
+            position = len(results)
+            results.append({
+                'type': 'article',
+                'id': str(position),
+                'title': html.unescape(a.name),
+                'description': '{} ({})'.format(
+                    'heute' if days_left == 0 else 'morgen' if days_left == 1 else 'in {} Tagen'.format(days_left),
+                    a.date.strftime('%d.%m.%Y')),
+                'input_message_content': {'message_text': text, 'parse_mode': 'HTML'},
+            })
+            index.extend((word, position) for word in set(normalize(a.name).split()))
+        index.sort()
+        self._results = results
+        self._index = index
+        logger.debug("Built inline results for %s academies", len(results))
@@ -0,0 +1,96 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import metrics
+
+DROPPED_RECORDS = metrics.REGISTRY.counter('countdown_log_records_dropped',
+                                           'Log records dropped because the log queue was full')
+
+TEXT_FORMAT = "%(asctime)s [%(levelname)-8s] %(name)s - %(message)s"
+# Attributes passed via `extra` which are included in JSON log lines
+JSON_FIELDS = ('chat_id', 'command', 'latency')
+
+_EXCEPTION_FORMATTER = logging.Formatter()
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format log records as JSON lines with the time, level, logger and message and the fields in JSON_FIELDS, if they
+    have been passed to the logging call via `extra`, e.g. `logger.debug(..., extra={'chat_id': chat_id})`.
+    """
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in JSON_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler which drops records instead of blocking if the queue is full, so a slow log sink never stalls the
+    thread logging the record.
+    """
+    def prepare(self, record):
+        """
+        Merge the message and its arguments in the logging thread (the arguments might change later), but keep the
+        traceback separate from the message, so formatters can place it.
+        """
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _EXCEPTION_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED_RECORDS.inc()
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for a free slot, as the queue may be full when the listener is stopped
+        self.queue.put(self._sentinel)
+
+
+def setup_logging(level, json_format=False, queue_size=10000):
+    """
+    Configure the root logger to hand all records to a background thread, which writes them to stderr. Records are
+    only formatted if they pass the level, so disabled debug messages cost no more than the level check.
+
+    :param level: The minimum level of logged records
+    :param json_format: Write JSON lines (see JsonFormatter) instead of plain text
+    :param queue_size: Maximum number of records waiting to be written. Further records are dropped.
+    :return: The QueueListener writing the records. It is stopped (writing all queued records) at exit.
+    :rtype: logging.handlers.QueueListener
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT))
+    log_queue = queue.Queue(queue_size)
+    listener = _QueueListener(log_queue, handler)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(DroppingQueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,301 @@
+"""
+Lightweight, always-on instrumentation: counters, gauges and histograms, which can be exported in the Prometheus text
+format by a small HTTP server and/or written to the log periodically.
+
+Metrics are registered in the module-level REGISTRY, usually at import time of the instrumented module:
+
+    REQUEST_TIME = metrics.REGISTRY.histogram('request_seconds', 'Latency of requests', ('method',))
+    REQUEST_TIME.observe(0.25, 'getUpdates')
+"""
+import bisect
+import http.server
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _samples(self):
+        """
+        :return: (suffix, labels, value) tuples in Prometheus text format order
+        """
+        raise NotImplementedError
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        for suffix, labels, value in self._samples():
+            label_text = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for k, v in labels)
+            lines.append("{}{}{} {}".format(self.name, suffix, '{' + label_text + '}' if label_text else '',
+                                            _format_value(value)))
+        return '\n'.join(lines)
+
+    def _labels(self, values):
+        return tuple(zip(self.labelnames, values))
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def total(self):
+        return sum(self._values.values())
+
+    def _samples(self):
+        with self._lock:
+            return [('_total' if not self.name.endswith('_total') else '', self._labels(k), v)
+                    for k, v in sorted(self._values.items(), key=lambda i: str(i[0]))]
+
+    def summary(self):
+        with self._lock:
+            return ', '.join('{}={}'.format('/'.join(map(str, k)) or 'all', v)
+                             for k, v in sorted(self._values.items(), key=lambda i: str(i[0])))
+
+
+class Gauge(_Metric):
+    """
+    A gauge which is either set explicitly or computed by a function on each export.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), function=None):
+        super().__init__(name, help_text, labelnames)
+        self.function = function
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def _current(self):
+        if self.function:
+            try:
+                return {(): self.function()}
+            except Exception as e:
+                logger.debug("Could not compute gauge %s: %s", self.name, e)
+                return {}
+        with self._lock:
+            return dict(self._values)
+
+    def _samples(self):
+        return [('', self._labels(k), v) for k, v in sorted(self._current().items(), key=lambda i: str(i[0]))]
+
+    def summary(self):
+        return ', '.join('{}={}'.format('/'.join(map(str, k)) or 'value', _format_value(v))
+                         for k, v in sorted(self._current().items(), key=lambda i: str(i[0])))
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(labels)
+            if data is None:
+                # Counts per bucket (non-cumulative, last one is +Inf), sum, count
+                data = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            data[0][i] += 1
+            data[1] += value
+            data[2] += 1
+
+    def time(self, *labels):
+        """
+        Context manager to observe the duration of a block
+        """
+        return _Timer(self, labels)
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items(), key=lambda i: str(i[0])):
+                labels = self._labels(key)
+                cumulative = 0
+                for bound, c in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += c
+                    samples.append(('_bucket', labels + (('le', _format_value(bound)),), cumulative))
+                samples.append(('_sum', labels, total))
+                samples.append(('_count', labels, count))
+        return samples
+
+    def quantile(self, q, *labels):
+        """
+        Estimate a quantile from the buckets (upper bound of the bucket containing the quantile)
+        """
+        with self._lock:
+            data = self._values.get(labels)
+            if not data or not data[2]:
+                return None
+            target = q * data[2]
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float('inf'),), data[0]):
+                cumulative += c
+                if cumulative >= target:
+                    return bound
+
+    def summary(self):
+        with self._lock:
+            keys = sorted(self._values, key=str)
+        parts = []
+        for key in keys:
+            counts, total, count = self._values[key]
+            parts.append("{}: n={} avg={:.4f}s p50<={} p99<={}".format(
+                '/'.join(map(str, key)) or 'all', count, total / count if count else 0,
+                _format_value(self.quantile(0.5, *key)), _format_value(self.quantile(0.99, *key))))
+        return '; '.join(parts)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                return self._metrics[metric.name]
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=(), function=None):
+        gauge = self._register(Gauge(name, help_text, labelnames, function))
+        if function:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """
+        :return: All metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(m.render() for m in metrics) + '\n'
+
+    def log_summary(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for m in metrics:
+            summary = m.summary()
+            if summary:
+                logger.info("%s: %s", m.name, summary)
+
+
+REGISTRY = Registry()
+
+
+class MetricsServer:
+    """
+    HTTP server exporting the metrics of a registry in the Prometheus text format at /metrics
+    """
+    def __init__(self, host='0.0.0.0', port=9100, registry=REGISTRY):
+        self.registry = registry
+        self.httpd = http.server.ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name='metrics', daemon=True).start()
+        logger.info("Serving metrics on port %s", self.httpd.server_address[1])
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _make_handler(self):
+        registry = self.registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = registry.render().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class StatsLogger:
+    """
+    Background thread writing a summary of all metrics to the log periodically
+    """
+    def __init__(self, interval, registry=REGISTRY):
+        self.interval = interval
+        self.registry = registry
+        self._stop = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name='stats-logger', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.registry.log_summary()
+
+
+def _format_value(value):
+    if value is None:
+        return '-'
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
@@ -0,0 +1,175 @@
+import contextlib
+import cProfile
+import datetime
+import logging
+import os
+import pstats
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_NO_SECTION = contextlib.nullcontext()
+
+
+class Profiler:
+    """
+    On-demand profiler for the running bot. While a profiling run is active, each profiled section (see `section()`)
+    is recorded with cProfile in the thread executing it. When the run ends – after a given time or number of
+    processed updates – the recorded profiles of all threads are merged, written to a pstats file and summarized.
+
+    Only one section is recorded at a time, as Python (since 3.12) only allows one active profiler per process.
+    Sections entered by other threads meanwhile are not recorded.
+
+    While no run is active, entering a section only costs a single attribute lookup.
+    """
+    def __init__(self, directory='.'):
+        """
+        :param directory: Directory to write the pstats files to
+        """
+        self.directory = directory
+        self.active = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Held while a section is recorded
+        self._recording = threading.Lock()
+        self._profiles = []
+        self._run = 0
+        self._deadline = None
+        self._updates_left = None
+        self._started = None
+        self._on_finish = None
+
+    def start(self, duration=None, updates=None, on_finish=None):
+        """
+        Start a profiling run. The run ends when `duration` seconds have passed or `updates` updates have been
+        processed, whichever comes first. The end of the run is detected when a section exits, so the run may last a
+        bit longer than `duration`.
+
+        :param duration: Maximum duration of the run (in seconds)
+        :type duration: float or None
+        :param updates: Maximum number of updates to profile
+        :type updates: int or None
+        :param on_finish: Function to call with the summary and the path of the pstats file when the run ends
+        :type on_finish: (str, str) -> None
+        :return: False if a run is already active
+        """
+        with self._lock:
+            if self.active:
+                return False
+            self._run += 1
+            self._profiles = []
+            self._started = time.monotonic()
+            self._deadline = self._started + duration if duration else None
+            self._updates_left = updates
+            self._on_finish = on_finish
+            self.active = True
+        logger.info("Profiling started (duration: %ss, updates: %s)", duration, updates)
+        return True
+
+    def section(self, update=False):
+        """
+        Context manager to profile a block of code in the current thread, if a run is active. Nested sections are
+        recorded as part of the outermost one.
+
+        :param update: True if the section processes a single update, which counts towards the run's update limit
+        """
+        if not self.active or getattr(self._local, 'profile', None) is not None:
+            return _NO_SECTION
+        return _Section(self, update)
+
+    def stop(self):
+        """
+        End the active run immediately, write the pstats file and call the run's `on_finish` function.
+
+        :return: The summary of the run or None if no run was active
+        """
+        with self._lock:
+            if not self.active:
+                return None
+            self.active = False
+            profiles = self._profiles
+            self._profiles = []
+            elapsed = time.monotonic() - self._started
+            on_finish = self._on_finish
+
+        if not profiles:
+            summary = "Profiling finished after {:.1f}s: Nothing has been recorded.".format(elapsed)
+            path = None
+        else:
+            stats = pstats.Stats(*profiles)
+            path = os.path.join(self.directory,
+                                'profile-{}.pstats'.format(datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+            stats.dump_stats(path)
+            summary = "Profiling finished after {:.1f}s ({} sections), stats written to {}\n\n{}".format(
+                elapsed, len(profiles), path, self.top_functions(stats))
+        logger.info(summary)
+
+        if on_finish:
+            try:
+                on_finish(summary, path)
+            except Exception as e:
+                logger.error("Error while reporting profiling results:", exc_info=e)
+        return summary
+
+    @staticmethod
+    def top_functions(stats, limit=15):
+        """
+        Format the functions with the highest own time of a pstats.Stats object.
+
+        :return: One line per function with own time, cumulative time, number of calls and location
+        :rtype: str
+        """
+        lines = ["{:>9} {:>9} {:>8}  function".format('own', 'total', 'calls')]
+        entries = sorted(stats.stats.items(), key=lambda i: i[1][2], reverse=True)
+        for (filename, line, function), (_cc, calls, own, total, _callers) in entries[:limit]:
+            location = '{}:{}'.format(os.path.basename(filename), line) if line else filename
+            lines.append("{:>8.4f}s {:>8.4f}s {:>8}  {} ({})".format(own, total, calls, function, location))
+        return '\n'.join(lines)
+
+    def _add(self, run, profile, update):
+        """
+        Add the profile of a finished section to the run and end the run if one of its limits has been reached.
+        """
+        with self._lock:
+            if not self.active or run != self._run:
+                return
+            self._profiles.append(profile)
+            if update and self._updates_left is not None:
+                self._updates_left -= 1
+            finished = ((self._updates_left is not None and self._updates_left <= 0)
+                        or (self._deadline is not None and time.monotonic() >= self._deadline))
+        if finished:
+            self.stop()
+
+
+class _Section:
+    __slots__ = ('profiler', 'update', 'run', 'profile')
+
+    def __init__(self, profiler, update):
+        self.profiler = profiler
+        self.update = update
+
+    def __enter__(self):
+        self.run = self.profiler._run
+        self.profile = None
+        if not self.profiler._recording.acquire(blocking=False):
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Another profiling tool is active (e.g. a debugger)
+            self.profiler._recording.release()
+            logger.debug("Section not profiled: %s", e)
+            return
+        self.profile = profile
+        self.profiler._local.profile = profile
+
+    def __exit__(self, *exc):
+        if self.profile is None:
+            return
+        self.profile.disable()
+        self.profiler._local.profile = None
+        self.profiler._recording.release()
+        self.profiler._add(self.run, self.profile, self.update)
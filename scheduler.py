@@ -0,0 +1,156 @@
+import bisect
+import datetime
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriptionScheduler:
+    """
+    In-memory index of all subscriptions by their time of day. The subscriptions are loaded from the database once and
+    kept up to date by `add()` and `remove()`. Subscriptions with the same time of day share a bucket, so finding the
+    next due time and the subscriptions due in an interval only costs a binary search over the distinct times.
+    """
+    def __init__(self):
+        # seconds of the day -> set of (chat_id, subscriptions)
+        self._buckets = {}
+        # sorted list of the keys of self._buckets
+        self._times = []
+        # chat_id -> set of seconds of the day
+        self._chats = {}
+        self._lock = threading.RLock()
+        self._listeners = []
+
+    def __len__(self):
+        return sum(len(b) for b in self._buckets.values())
+
+    def load(self, db):
+        """
+        (Re)load all subscriptions from the database.
+
+        :type db: dbhelper.DBHelper
+        """
+        with self._lock:
+            self._buckets = {}
+            self._times = []
+            self._chats = {}
+            for chat_id, subscriptions, time in db.get_all_subscriptions():
+                self._add(chat_id, subscriptions, time)
+        logger.info("Loaded %s subscriptions", len(self))
+        self._notify()
+
+    def add_listener(self, callback):
+        """
+        Register a function to be called (without arguments) whenever the subscriptions change, e.g. to wake up a
+        sleeping delivery loop.
+        """
+        self._listeners.append(callback)
+
+    def add(self, chat_id, subscriptions, time='06:00:00'):
+        with self._lock:
+            self._add(chat_id, subscriptions, time)
+        self._notify()
+
+    def remove(self, chat_id, time=None):
+        """
+        Remove the subscriptions of a chat at the given time of day or all subscriptions of the chat if no time is
+        given.
+        """
+        chat_id = str(chat_id)
+        with self._lock:
+            seconds = self._chats.pop(chat_id, set())
+            if time is not None:
+                remaining = seconds - {self._parse_time(time)}
+                if remaining:
+                    self._chats[chat_id] = remaining
+                seconds = seconds - remaining
+            for s in seconds:
+                bucket = self._buckets[s]
+                for entry in [e for e in bucket if e[0] == chat_id]:
+                    bucket.discard(entry)
+                if not bucket:
+                    del self._buckets[s]
+                    del self._times[bisect.bisect_left(self._times, s)]
+        self._notify()
+
+    def next_due(self, after):
+        """
+        Get the time of the next subscription after the given time.
+
+        :param after: Point in time after which to search for the next subscription
+        :type after: datetime.datetime
+        :return: The time the next subscription is due or None if there are no subscriptions
+        :rtype: datetime.datetime or None
+        """
+        with self._lock:
+            if not self._times:
+                return None
+            seconds = self._seconds_of_day(after)
+            i = bisect.bisect_right(self._times, seconds)
+            day = after.date()
+            if i == len(self._times):
+                i = 0
+                day += datetime.timedelta(days=1)
+            return datetime.datetime.combine(day, datetime.time()) + datetime.timedelta(seconds=self._times[i])
+
+    def due(self, start, end, subscriptions=None):
+        """
+        Get all subscriptions which were due in the interval (start, end]. Each subscription is returned at most once,
+        even if the interval is longer than a day.
+
+        :param start: Exclusive start of the interval
+        :type start: datetime.datetime
+        :param end: Inclusive end of the interval
+        :type end: datetime.datetime
+        :param subscriptions: Only return subscriptions of this type
+        :type subscriptions: str or None
+        :return: A list of (chat_id, subscriptions, time of day as 'HH:MM:SS') tuples
+        """
+        start = max(start, end - datetime.timedelta(days=1))
+        if start >= end:
+            return []
+
+        # Split the interval at midnight into ranges of seconds of the day
+        start_seconds = self._seconds_of_day(start)
+        end_seconds = self._seconds_of_day(end)
+        if start.date() == end.date():
+            ranges = [(start_seconds, end_seconds)]
+        else:
+            ranges = [(start_seconds, 86400), (-1, end_seconds)]
+
+        result = []
+        with self._lock:
+            for low, high in ranges:
+                for i in range(bisect.bisect_right(self._times, low), bisect.bisect_right(self._times, high)):
+                    seconds = self._times[i]
+                    time = self._format_time(seconds)
+                    result.extend((chat_id, s, time) for chat_id, s in self._buckets[seconds]
+                                  if subscriptions is None or s == subscriptions)
+        return result
+
+    def _add(self, chat_id, subscriptions, time):
+        chat_id = str(chat_id)
+        seconds = self._parse_time(time)
+        if seconds not in self._buckets:
+            self._buckets[seconds] = set()
+            bisect.insort(self._times, seconds)
+        self._buckets[seconds].add((chat_id, subscriptions))
+        self._chats.setdefault(chat_id, set()).add(seconds)
+
+    def _notify(self):
+        for callback in self._listeners:
+            callback()
+
+    @staticmethod
+    def _parse_time(time):
+        h, m, s = time.split(':')
+        return int(h) * 3600 + int(m) * 60 + int(s)
+
+    @staticmethod
+    def _format_time(seconds):
+        return '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+    @staticmethod
+    def _seconds_of_day(t):
+        return t.hour * 3600 + t.minute * 60 + t.second + t.microsecond / 1e6
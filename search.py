@@ -0,0 +1,90 @@
+import collections
+import html
+import re
+
+_WORD_PATTERN = re.compile(r'\w+')
+
+
+def normalize(text):
+    """
+    Normalize a name or a search query for matching: Unescape HTML entities (names are stored escaped), lower case and
+    collapse everything but letters and digits to single spaces.
+
+    :type text: str
+    :rtype: str
+    """
+    return ' '.join(_WORD_PATTERN.findall(html.unescape(text).lower()))
+
+
+def trigrams(text):
+    """
+    Get the trigrams of a normalized text. Like PostgreSQL's pg_trgm, each word is padded with two spaces in front and
+    one at the end, so that word beginnings weigh more than word endings.
+
+    :rtype: {str}
+    """
+    result = set()
+    for word in text.split():
+        word = '  ' + word + ' '
+        result.update(word[i:i+3] for i in range(len(word) - 2))
+    return result
+
+
+class TrigramIndex:
+    """
+    Immutable in-memory index for case-insensitive substring and fuzzy search. Each item is indexed under the trigrams
+    of its key, so a search only scores the items sharing a trigram with the query instead of scanning all items.
+    """
+    # Minimum share of the query's trigrams an item must contain to match fuzzily
+    MIN_SIMILARITY = 0.5
+
+    def __init__(self, items, key):
+        """
+        :param items: The items to index
+        :param key: Function returning the text of an item to search in
+        """
+        self._items = list(items)
+        self._keys = [normalize(key(item)) for item in self._items]
+        self._postings = collections.defaultdict(list)
+        for position, k in enumerate(self._keys):
+            for trigram in trigrams(k):
+                self._postings[trigram].append(position)
+
+    def search(self, query):
+        """
+        Find the items matching a query. An item matches if its key is equal to the query, contains the query or
+        contains at least MIN_SIMILARITY of the query's trigrams (to tolerate typos).
+
+        :return: (score, item) pairs of the matching items, in the order of the index. The score is 3 for an exact
+                 match, 2 for a match at the beginning of a word, 1 for another substring and below 1 for a fuzzy
+                 match.
+        :rtype: [(float, object)]
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        query_trigrams = trigrams(query)
+
+        shared = collections.Counter()
+        for trigram in query_trigrams:
+            shared.update(self._postings.get(trigram, ()))
+        # Queries shorter than a trigram share no trigram with words containing them in the middle, so all items are
+        # checked. That is still cheap, as the query is compared to each key only once.
+        candidates = shared.keys() if len(query) >= 3 else range(len(self._keys))
+
+        results = []
+        for position in sorted(candidates):
+            k = self._keys[position]
+            if k == query:
+                score = 3
+            elif ' ' + query in ' ' + k:
+                score = 2
+            elif query in k:
+                score = 1
+            else:
+                score = shared[position] / len(query_trigrams)
+                if score < self.MIN_SIMILARITY:
+                    continue
+                score = min(score, 0.99)
+            results.append((score, self._items[position]))
+        return results
@@ -0,0 +1,306 @@
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from tclient import split_message, ERROR_TRANSIENT
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Classic token bucket: Tokens are refilled continuously with `rate` tokens per second up to `capacity` tokens. Each
+    sent message consumes one token.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.last:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    def delay(self, now):
+        """
+        :return: Seconds until a token is available (0 if a token is available now)
+        """
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Item:
+    __slots__ = ('function', 'args', 'future', 'attempts')
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.future = Future()
+        self.attempts = 0
+
+
+class SendQueue:
+    """
+    Outbound message queue in front of a TClient, which sends messages as fast as the Telegram rate limits allow:
+    A global token bucket limits the overall message rate, a token bucket per chat limits the rate per chat and a
+    stricter one applies to group chats. If Telegram responds with 429 "Too Many Requests", the message is requeued
+    and sent again after the `retry_after` time given by Telegram.
+
+    The sending methods have the same signature as the TClient's methods. They enqueue the request and return a
+    concurrent.futures.Future, which resolves to the API result. Messages to the same chat are sent in order. Texts
+    exceeding Telegram's message length limit are split before they are queued, so that each part is rate limited and
+    retried on its own. All other attributes (like `get_updates()`) are forwarded to the wrapped TClient.
+    """
+    CLEANUP_INTERVAL = 1000
+
+    def __init__(self, tclient, workers=4, global_rate=30, chat_rate=1, chat_burst=3, group_rate=20/60,
+                 group_burst=5, max_size=100000, max_attempts=5):
+        """
+        :param tclient: The Telegram client to send the messages with
+        :type tclient: tclient.TClient
+        :param workers: Number of threads sending messages concurrently
+        :param global_rate: Maximum number of messages per second in total
+        :param chat_rate: Maximum number of messages per second to a single chat
+        :param chat_burst: Number of messages that may be sent to a single chat at once
+        :param group_rate: Maximum number of messages per second to a single group chat
+        :param group_burst: Number of messages that may be sent to a single group chat at once
+        :param max_size: Maximum number of queued messages. Further messages are dropped.
+        :param max_attempts: Maximum number of tries for each message before it is dropped
+        """
+        self.tclient = tclient
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+
+        self.depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.rate_limited = 0
+
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._group_buckets = {}
+        self._chats = {}
+        self._ready = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        # Number of requests taken from the queue, to clean up the token buckets regularly
+        self._processed = 0
+        self._workers = [threading.Thread(target=self._work, name='sendqueue-{}'.format(i), daemon=True)
+                         for i in range(workers)]
+        for w in self._workers:
+            w.start()
+
+    def __getattr__(self, name):
+        return getattr(self.tclient, name)
+
+    def __str__(self):
+        return "{} queued, {} sent, {} failed, {} dropped, {} rate limited by Telegram ({})".format(
+            self.depth, self.sent, self.failed, self.dropped, self.rate_limited, self.tclient.stats)
+
+    def send_message(self, text, chat_id, reply_markup=None, parse_mode="HTML"):
+        """
+        Queue a text message. The parts of a long text are queued at once, so they are sent as one ordered batch.
+
+        :return: A Future of the result of the (last part of the) message
+        """
+        parts = split_message(text, parse_mode)
+        return self._submit(chat_id, *((self.tclient.send_message,
+                                        (part, chat_id, reply_markup if i == len(parts) - 1 else None, parse_mode))
+                                       for i, part in enumerate(parts)))
+
+    def send_sticker(self, sticker, chat_id):
+        return self._submit(chat_id, (self.tclient.send_sticker, (sticker, chat_id)))
+
+    def edit_message_text(self, text, chat_id, message_id, reply_markup=None, parse_mode="HTML"):
+        return self._submit(chat_id, (self.tclient.edit_message_text,
+                                      (text, chat_id, message_id, reply_markup, parse_mode)))
+
+    def delete_message(self, chat_id, message_id):
+        return self._submit(chat_id, (self.tclient.delete_message, (chat_id, message_id)))
+
+    def pin_chat_message(self, chat_id, message_id, disable_notification=True):
+        return self._submit(chat_id, (self.tclient.pin_chat_message, (chat_id, message_id, disable_notification)))
+
+    def join(self, timeout=None):
+        """
+        Wait until the queue is empty and all messages have been sent.
+
+        :return: True if the queue was drained, False on timeout
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self.depth == 0, timeout)
+
+    def close(self, timeout=30):
+        """
+        Send remaining messages (waiting up to `timeout` seconds), stop the worker threads and close the TClient.
+        """
+        self.join(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for w in self._workers:
+            w.join(1)
+        self.tclient.close()
+
+    def _submit(self, chat_id, *calls):
+        """
+        Queue one or more requests to a chat. The requests are queued at once, so no other request to the chat gets in
+        between.
+
+        :param calls: (function, args) tuples of the requests
+        :return: The Future of the last request
+        """
+        items = [_Item(function, args) for function, args in calls]
+        with self._cond:
+            if self.depth + len(items) > self.max_size or self._closed:
+                self.dropped += len(items)
+                logger.warning("Send queue is full. Dropping message to chat %s", chat_id)
+                for item in items:
+                    item.future.set_result({'ok': False, 'error': ERROR_TRANSIENT, 'description': 'Send queue is full'})
+                return items[-1].future
+            self.depth += len(items)
+            if chat_id in self._chats:
+                self._chats[chat_id].extend(items)
+            else:
+                self._chats[chat_id] = collections.deque(items)
+                self._push_ready(chat_id, 0)
+        return items[-1].future
+
+    def _push_ready(self, chat_id, not_before):
+        heapq.heappush(self._ready, (not_before, next(self._seq), chat_id))
+        self._cond.notify()
+
+    def _chat_delay(self, chat_id, now):
+        if chat_id not in self._chat_buckets:
+            self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        delay = self._chat_buckets[chat_id].delay(now)
+        if self._is_group(chat_id):
+            if chat_id not in self._group_buckets:
+                self._group_buckets[chat_id] = TokenBucket(self.group_rate, self.group_burst)
+            delay = max(delay, self._group_buckets[chat_id].delay(now))
+        return delay
+
+    def _next_item(self):
+        """
+        Wait until a message may be sent without exceeding a rate limit and take it from the queue. Must be called
+        with self._cond acquired.
+
+        :return: (chat_id, item) or None if the queue has been closed
+        """
+        while True:
+            if self._closed and not self._ready:
+                return None
+            if not self._ready:
+                self._cond.wait()
+                continue
+
+            not_before, _seq, chat_id = self._ready[0]
+            now = time.monotonic()
+            if not_before > now:
+                self._cond.wait(not_before - now)
+                continue
+
+            chat_delay = self._chat_delay(chat_id, now)
+            if chat_delay > 0:
+                # Let other chats pass while this one has to wait for its rate limit
+                heapq.heapreplace(self._ready, (now + chat_delay, next(self._seq), chat_id))
+                continue
+
+            global_delay = self._global_bucket.delay(now)
+            if global_delay > 0:
+                self._cond.wait(global_delay)
+                continue
+
+            heapq.heappop(self._ready)
+            self._global_bucket.consume(now)
+            self._chat_buckets[chat_id].consume(now)
+            if chat_id in self._group_buckets:
+                self._group_buckets[chat_id].consume(now)
+            return chat_id, self._chats[chat_id][0]
+
+    def _work(self):
+        while True:
+            with self._cond:
+                next_item = self._next_item()
+            if next_item is None:
+                return
+            chat_id, item = next_item
+
+            item.attempts += 1
+            try:
+                result = item.function(*item.args)
+            except Exception as e:
+                logger.error("Error while sending queued request to chat %s:", chat_id, exc_info=e)
+                result = {'ok': False, 'error': ERROR_TRANSIENT, 'description': str(e)}
+
+            retry_after = self._get_retry_after(result)
+            with self._cond:
+                if retry_after is not None and item.attempts < self.max_attempts:
+                    self.rate_limited += 1
+                    logger.info("Rate limited by Telegram. Retrying message to chat %s in %s seconds",
+                                chat_id, retry_after)
+                    self._push_ready(chat_id, time.monotonic() + retry_after)
+                    continue
+
+                if retry_after is not None:
+                    self.dropped += 1
+                    logger.warning("Dropping message to chat %s after %s attempts", chat_id, item.attempts)
+                elif result.get('ok'):
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                self._chats[chat_id].popleft()
+                self.depth -= 1
+                if self._chats[chat_id]:
+                    self._push_ready(chat_id, 0)
+                else:
+                    del self._chats[chat_id]
+                self._processed += 1
+                if self._processed % self.CLEANUP_INTERVAL == 0:
+                    self._cleanup_buckets()
+                self._cond.notify_all()
+            item.future.set_result(result)
+
+    def _cleanup_buckets(self):
+        """
+        Remove the token buckets of idle chats which have been refilled completely
+        """
+        now = time.monotonic()
+        for buckets in (self._chat_buckets, self._group_buckets):
+            for chat_id in [c for c, b in buckets.items() if c not in self._chats and b.is_full(now)]:
+                del buckets[chat_id]
+
+    @staticmethod
+    def _get_retry_after(result):
+        """
+        :return: The number of seconds to wait if the result is a 429 "Too Many Requests" error, None otherwise
+        """
+        if result.get('error_code') == 429:
+            return result.get('parameters', {}).get('retry_after', 1)
+        return None
+
+    @staticmethod
+    def _is_group(chat_id):
+        """
+        Group and channel chat ids are negative, user chat ids are positive
+        """
+        return int(chat_id) < 0
@@ -0,0 +1,136 @@
+import datetime
+import logging
+import os
+import socket
+import time
+import uuid
+import zlib
+
+logger = logging.getLogger(__name__)
+
+WATERMARK_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def shard_of(chat_id, shard_count):
+    """
+    Get the shard a chat belongs to. The hash is stable across processes and restarts (unlike Python's `hash()`).
+
+    :type chat_id: int or str
+    :type shard_count: int
+    :rtype: int
+    """
+    return zlib.crc32(str(chat_id).encode('ascii')) % shard_count
+
+
+class ShardCoordinator:
+    """
+    Coordinates several bot processes sharing one database via leases stored in the database. Subscription delivery is
+    split into `shard_count` shards by the hash of the chat id. Each process has a preferred shard, whose lease it keeps
+    renewing. Shards whose owner has died are taken over temporarily by other processes until the owner returns. Exactly
+    one process holds the 'poller' lease and polls for updates.
+
+    Each shard's lease stores the time up to which its subscriptions have been delivered, so a process taking over a
+    shard continues where the previous owner stopped, without sending subscriptions twice.
+    """
+    POLLER = 'poller'
+
+    def __init__(self, db, shard, shard_count, lease_time=30):
+        """
+        :param db: The shared database
+        :type db: dbhelper.DBHelper
+        :param shard: The preferred shard of this process. The process with shard 0 prefers to poll for updates.
+        :param shard_count: Total number of shards
+        :param lease_time: Time (in seconds) until the leases of a stopped process expire
+        """
+        self.db = db
+        self.shard = shard
+        self.shard_count = shard_count
+        self.lease_time = lease_time
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.shards = set()
+        self.is_poller = False
+        self._watermarks = {}
+        # Foreign shard -> time.monotonic() until which it is processed by this process
+        self._foreign_until = {}
+        # Foreign shard -> time.monotonic() after which this process may take it over again
+        self._foreign_retry = {}
+        self._last_renewal = None
+
+    def renew(self, force=False):
+        """
+        Renew the held leases and take over the leases of stopped processes. Cheap if the leases have been renewed
+        recently, so it may be called in every iteration of the main loop.
+        """
+        now = time.monotonic()
+        if not force and self._last_renewal is not None and now - self._last_renewal < self.lease_time / 3:
+            return
+        self._last_renewal = now
+
+        self.is_poller = self._acquire(self.POLLER, preferred=self.shard == 0 or self.is_poller)
+        shards = set()
+        for shard in range(self.shard_count):
+            if shard == self.shard:
+                acquired = self._acquire(self._lease_name(shard), preferred=True)
+            elif shard in self.shards and now < self._foreign_until[shard]:
+                acquired = True
+            elif now < self._foreign_retry.get(shard, 0):
+                acquired = False
+            else:
+                # Foreign shards are not renewed, but given up one renewal interval before their lease expires. They
+                # are only taken over again after the lease's grace period, so that their owner can get them back
+                # after a restart.
+                acquired = self._acquire(self._lease_name(shard), preferred=False)
+                if acquired:
+                    self._foreign_until[shard] = now + self.lease_time * 2 / 3
+                    self._foreign_retry[shard] = now + self.lease_time * 2
+            if acquired:
+                shards.add(shard)
+        for shard in shards - self.shards:
+            logger.info("Acquired subscription shard %s/%s", shard, self.shard_count)
+            self._watermarks[shard] = self._load_watermark(shard)
+        for shard in self.shards - shards:
+            logger.info("Released subscription shard %s/%s", shard, self.shard_count)
+            self._watermarks.pop(shard, None)
+            self._foreign_until.pop(shard, None)
+        self.shards = shards
+
+    def release(self):
+        """
+        Release all leases, e.g. on shutdown, so that other processes can take them over immediately.
+        """
+        for shard in self.shards:
+            self.db.release_lease(self._lease_name(shard), self.owner)
+        if self.is_poller:
+            self.db.release_lease(self.POLLER, self.owner)
+        self.shards = set()
+        self.is_poller = False
+
+    def watermark(self, shard):
+        """
+        :return: The time up to which the subscriptions of the shard have been delivered or None if unknown
+        :rtype: datetime.datetime or None
+        """
+        return self._watermarks.get(shard)
+
+    def set_watermark(self, shard, watermark):
+        """
+        Store the time up to which the subscriptions of a held shard have been delivered.
+
+        :type watermark: datetime.datetime
+        """
+        if self.db.set_lease_watermark(self._lease_name(shard), self.owner, watermark.strftime(WATERMARK_FORMAT)):
+            self._watermarks[shard] = watermark
+        else:
+            logger.warning("Lost the lease of subscription shard %s/%s", shard, self.shard_count)
+            self.shards.discard(shard)
+            self._watermarks.pop(shard, None)
+
+    def _acquire(self, name, preferred):
+        return self.db.acquire_lease(name, self.owner, self.lease_time, grace=0 if preferred else self.lease_time)
+
+    def _load_watermark(self, shard):
+        watermark = self.db.get_lease_watermark(self._lease_name(shard))
+        return datetime.datetime.strptime(watermark, WATERMARK_FORMAT) if watermark else None
+
+    def _lease_name(self, shard):
+        return 'shard-{}/{}'.format(shard, self.shard_count)
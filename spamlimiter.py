@@ -0,0 +1,84 @@
+import datetime
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SpamLimiter:
+    """
+    Rate limiter for group chats, which keeps the time of the last listing per chat in memory. Changes are written to
+    the database in batches by `flush()`, so checking the limit does not cost any disk I/O. Entries are evicted from
+    memory when they are older than the cooldown time and have been written to the database.
+    """
+    TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+    def __init__(self, db, cooldown, flush_interval=60):
+        """
+        :param db: The database to load the state from and persist it to
+        :type db: dbhelper.DBHelper
+        :param cooldown: Minimum time between two listings in a group chat
+        :type cooldown: datetime.timedelta
+        :param flush_interval: Maximum time (in seconds) between writing changes to the database
+        :type flush_interval: float
+        """
+        self.db = db
+        self.cooldown = cooldown
+        self.flush_interval = flush_interval
+        self._last_message = {}
+        self._dirty = set()
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """
+        Load the last message times of all chats still in their cooldown from the database
+        """
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            self._last_message = {}
+            for chat_id, last_message in self.db.get_last_message_times():
+                try:
+                    t = datetime.datetime.strptime(last_message, self.TIME_FORMAT)
+                except (TypeError, ValueError):
+                    continue
+                if now - t < self.cooldown:
+                    self._last_message[str(chat_id)] = t
+            self._dirty = set()
+
+    def check(self, chat_id):
+        """
+        Check if a listing in the given chat would be too much spam. If not, the current time is recorded as the chat's
+        last listing.
+
+        :return: True if the listing must be suppressed
+        """
+        chat_id = str(chat_id)
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            last_message = self._last_message.get(chat_id)
+            if last_message and now - last_message < self.cooldown:
+                return True
+            self._last_message[chat_id] = now
+            self._dirty.add(chat_id)
+            return False
+
+    def flush(self, force=True):
+        """
+        Write changed entries to the database and evict expired entries from memory.
+
+        :param force: If False, only flush if the flush interval has passed since the last flush
+        """
+        if not force and time.monotonic() - self._last_flush < self.flush_interval:
+            return
+        with self._lock:
+            self._last_flush = time.monotonic()
+            changes = [(chat_id, self._last_message[chat_id].strftime(self.TIME_FORMAT)) for chat_id in self._dirty]
+            self._dirty = set()
+            expired = datetime.datetime.utcnow() - self.cooldown
+            self._last_message = {c: t for c, t in self._last_message.items() if t > expired}
+        if changes:
+            self.db.set_last_message_times(changes)
+            logger.debug("Persisted last message times of %s chats", len(changes))
@@ -1,39 +1,182 @@
 import logging
+import threading
+import time
 import requests
 import json
-import urllib.parse
+import re
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics
 
 logger = logging.getLogger(__name__)
 
+REQUEST_TIME = metrics.REGISTRY.histogram('telegram_request_seconds', 'Latency of Telegram API requests', ('method',))
+API_ERRORS = metrics.REGISTRY.counter('telegram_errors', 'Failed Telegram API requests', ('method', 'code'))
+MESSAGES_SENT = metrics.REGISTRY.counter('telegram_messages_sent', 'Messages sent to the Telegram API', ('method',))
+
+# Maximum length of a message text
+MAX_MESSAGE_LENGTH = 4096
+
+# Classes of failed requests, stored as 'error' in their results (see classify_error())
+# The bot can't send to the chat anymore: It has been blocked or removed from the chat or the chat has been deleted
+ERROR_CHAT_GONE = 'chat_gone'
+# The group has been upgraded to a supergroup with a new chat id (given as 'migrate_to_chat_id' in the 'parameters')
+ERROR_MIGRATED = 'migrated'
+# Too many requests, the request may be retried after 'retry_after' seconds (given in the 'parameters')
+ERROR_RATE_LIMITED = 'rate_limited'
+# Network and server errors, the request may succeed when retried
+ERROR_TRANSIENT = 'transient'
+# Any other error, e.g. an invalid request
+ERROR_INVALID = 'invalid'
+
+_CHAT_GONE_PATTERN = re.compile(r'chat not found|group chat was (deleted|deactivated)|PEER_ID_INVALID', re.IGNORECASE)
+
+_TAG_PATTERN = re.compile(r'<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^>]*>')
+_ENTITY_PATTERN = re.compile(r'&#?[a-zA-Z0-9]+;')
+
+
+class ConnectionStats:
+	"""
+	Thread safe counters of the HTTP connections used by a TClient. Every request checks out a connection from the
+	pool; if the pool has no idle keep-alive connection, a new one (TCP + TLS handshake) is opened.
+	"""
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.checkouts = 0
+		self.new_connections = 0
+
+	def count_checkout(self):
+		with self._lock:
+			self.checkouts += 1
+
+	def count_new_connection(self):
+		with self._lock:
+			self.new_connections += 1
+
+	@property
+	def reused(self):
+		return max(self.checkouts - self.new_connections, 0)
+
+	def __str__(self):
+		return "{} requests, {} reused connections, {} new connections".format(
+			self.checkouts, self.reused, self.new_connections)
+
+
+class _CountingHTTPAdapter(HTTPAdapter):
+	"""
+	HTTPAdapter that reports connection reuse to a ConnectionStats object by hooking into the connection pools created
+	by its urllib3 PoolManager.
+	"""
+	def __init__(self, stats, **kwargs):
+		self.stats = stats
+		super().__init__(**kwargs)
+
+	def init_poolmanager(self, *args, **kwargs):
+		super().init_poolmanager(*args, **kwargs)
+		self.poolmanager.pool_classes_by_scheme = {
+			scheme: self._counting_pool_class(cls)
+			for scheme, cls in self.poolmanager.pool_classes_by_scheme.items()}
+
+	def _counting_pool_class(self, cls):
+		stats = self.stats
+
+		def _get_conn(pool, timeout=None):
+			stats.count_checkout()
+			return cls._get_conn(pool, timeout=timeout)
+
+		def _new_conn(pool):
+			stats.count_new_connection()
+			return cls._new_conn(pool)
+
+		return type("Counting" + cls.__name__, (cls,), {'_get_conn': _get_conn, '_new_conn': _new_conn})
+
 
 class TClient:
-	URL = "https://api.telegram.org/bot{}/{}"
+	API_URL = "https://api.telegram.org"
 
-	def __init__(self, token):
+	def __init__(self, token, pool_size=10, connect_timeout=5.0, read_timeout=15.0, retries=3, backoff_factor=0.5,
+	             base_url=API_URL):
+		"""
+		Create a Telegram client, which keeps a pool of keep-alive connections to the Telegram API.
+
+		:param token: The Telegram bot token
+		:param pool_size: Maximum number of idle connections kept open to the Telegram API
+		:param connect_timeout: Timeout for establishing a connection (in seconds)
+		:param read_timeout: Timeout for waiting on a response (in seconds). Long polling requests add their own
+		                     timeout on top of this value.
+		:param retries: Number of retries for failed connection attempts and 5xx responses to file downloads
+		:param backoff_factor: Exponential backoff between retries: {backoff factor} * 2^({retry number} - 1) seconds
+		:param base_url: Base URL of the Bot API, e.g. to use a local Bot API server or a fake API for testing
+		"""
+		self.URL = base_url.rstrip('/') + "/bot{}/{}"
+		self.FILE_URL = base_url.rstrip('/') + "/file/bot{}/{}"
 		self.token = token
 		self.last_update_id = None
+		self.connect_timeout = connect_timeout
+		self.read_timeout = read_timeout
+		self.stats = ConnectionStats()
+
+		# Read errors and 5xx responses to API calls (POST) are not retried: The Telegram API might have already
+		# processed the request, so retrying could deliver a message twice. Failed messages are retried by the outbox
+		# instead.
+		# Only file downloads (GET) are retried on 5xx responses.
+		retry = Retry(total=retries, connect=retries, read=0, status=retries, backoff_factor=backoff_factor,
+		              status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset({'GET'}), raise_on_status=False)
+		adapter = _CountingHTTPAdapter(self.stats, pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+		self.session = requests.Session()
+		self.session.mount("https://", adapter)
+		self.session.mount("http://", adapter)
+
+	def close(self):
+		self.session.close()
 
-	def _get_json_from_url(self, url):
+	def _request(self, method, params=None, timeout=0):
+		"""
+		Call a method of the Bot API. The parameters are sent as JSON request body, so they are not limited by the
+		maximum URL length.
+
+		:param method: Name of the API method, e.g. 'sendMessage'
+		:param params: Parameters of the method. Parameters with value None are omitted.
+		:type params: dict or None
+		:param timeout: Additional read timeout for long polling requests (in seconds)
+		:return: The decoded API response. The result of a failed request has 'ok' set to False and the class of the
+		         error as 'error' (one of the ERROR_* constants).
+		:rtype: dict
+		"""
+		params = {k: v for k, v in (params or {}).items() if v is not None}
+		start = time.perf_counter()
 		try:
-			response = requests.get(self.URL.format(self.token, url))
+			response = self.session.post(self.URL.format(self.token, method), json=params,
+			                             timeout=(self.connect_timeout, self.read_timeout + timeout))
 			content = response.content.decode("utf8")
 			js = json.loads(content)
 		except Exception as e:
-			logger.error("Error while trying to access Telegram url '{}':".format(url), exc_info=e)
-			return {}
+			API_ERRORS.inc(method, 'exception')
+			logger.error("Error while calling Telegram method '%s':", method, exc_info=e)
+			return {'ok': False, 'error': ERROR_TRANSIENT, 'description': str(e)}
+		finally:
+			REQUEST_TIME.observe(time.perf_counter() - start, method)
 
+		if not js.get('ok'):
+			API_ERRORS.inc(method, js.get('error_code', 'unknown'))
+			js['error'] = classify_error(js)
+		elif method.startswith('send'):
+			MESSAGES_SENT.inc(method)
 		return js
 
+	def set_update_offset(self, offset):
+		"""
+		Set the id of the next update to fetch, e.g. to continue polling after a restart without receiving already
+		processed updates again.
+		"""
+		self.last_update_id = offset
+
 	def get_updates(self, timeout):
-		url = "getUpdates?timeout={}".format(timeout)
-		if self.last_update_id:
-			url += "&offset={}".format(self.last_update_id)
-		result = self._get_json_from_url(url)
+		result = self._request("getUpdates", {'timeout': timeout, 'offset': self.last_update_id}, timeout=timeout)
 
 		# Log and Return on error
 		if 'ok' not in result or not result['ok']:
-			logger.error("Error while fetching Telegram updates: {}".format(
-				result['description'] if 'description' in result else '-- unknown --'))
+			logger.error("Error while fetching Telegram updates: %s", result.get('description', '-- unknown --'))
 			return []
 
 		if result['result']:
@@ -41,53 +184,293 @@ class TClient:
 		return result['result']
 
 	def send_message(self, text, chat_id, reply_markup=None, parse_mode="HTML"):
-		text = urllib.parse.quote_plus(text)
-		url = "sendMessage?text={}&chat_id={}".format(text, chat_id)
-		if reply_markup:
-			reply_markup = urllib.parse.quote_plus(reply_markup)
-			url += "&reply_markup={}".format(reply_markup)
-		if parse_mode:
-			url += "&parse_mode={}".format(parse_mode)
-		result = self._get_json_from_url(url)
-		
-		# Check result and log errors
-		if 'ok' not in result or not result['ok']:
-			logger.error("Error while sending message to Telegram API: {}".format(
-				result['description'] if 'description' in result else '-- unknown --'))
-				
+		"""
+		Send a text message. Texts exceeding Telegram's message length limit are split into several messages (see
+		`split_message()`), which are sent in order. The reply markup is attached to the last one.
+
+		:return: The API result of the last message, or of the first message which could not be sent
+		"""
+		parts = split_message(text, parse_mode)
+		for i, part in enumerate(parts):
+			result = self._request("sendMessage", {
+				'text': part,
+				'chat_id': chat_id,
+				'reply_markup': _decode_markup(reply_markup) if i == len(parts) - 1 else None,
+				'parse_mode': parse_mode})
+
+			# Check result and log errors
+			if 'ok' not in result or not result['ok']:
+				logger.error("Error while sending message to Telegram API: %s",
+					result.get('description', '-- unknown --'))
+				break
+		return result
+
 	def send_sticker(self, sticker, chat_id):
-		url = "sendSticker?sticker={}&chat_id={}".format(sticker, chat_id)
-		result = self._get_json_from_url(url)
+		result = self._request("sendSticker", {'sticker': sticker, 'chat_id': chat_id})
 		
 		# Check result and log errors
 		if 'ok' not in result or not result['ok']:
-			logger.error("Error while sending Sticker to Telegram API: {}".format(
-				result['description'] if 'description' in result else '-- unknown --'))
+			logger.error("Error while sending Sticker to Telegram API: %s", result.get('description', '-- unknown --'))
+		return result
 		
 	def edit_message_text(self, text, chat_id, message_id, reply_markup=None, parse_mode="HTML"):
-		text = urllib.parse.quote_plus(text)
-		url = "editMessageText?text={}&chat_id={}&message_id={}".format(text, chat_id, message_id)
-		if reply_markup:
-			reply_markup = urllib.parse.quote_plus(reply_markup)
-			url += "&reply_markup={}".format(reply_markup)
-		if parse_mode:
-			url += "&parse_mode={}".format(parse_mode)
-		result = self._get_json_from_url(url)
+		"""
+		Edit the text of a message. A message can't be split into several ones, so texts exceeding Telegram's message
+		length limit are truncated at a safe boundary.
+		"""
+		parts = split_message(text, parse_mode)
+		if len(parts) > 1:
+			logger.warning("Truncating edited message in chat %s to %s characters", chat_id, len(parts[0]))
+		result = self._request("editMessageText", {
+			'text': parts[0],
+			'chat_id': chat_id,
+			'message_id': message_id,
+			'reply_markup': _decode_markup(reply_markup),
+			'parse_mode': parse_mode})
 
 		# Check result and log errors
 		if 'ok' not in result or not result['ok']:
-			logger.error("Error while editing message via Telegram API: {}".format(
-				result['description'] if 'description' in result else '-- unknown --'))
+			logger.error("Error while editing message via Telegram API: %s", result.get('description', '-- unknown --'))
+		return result
 
 	def delete_message(self, chat_id, message_id):
-		url = "deleteMessage?chat_id={}&message_id={}".format(chat_id, message_id)
-		result = self._get_json_from_url(url)
+		result = self._request("deleteMessage", {'chat_id': chat_id, 'message_id': message_id})
+
+		# Check result and log errors
+		if 'ok' not in result or not result['ok']:
+			logger.error("Error while deleting message via Telegram API: %s",
+				result.get('description', '-- unknown --'))
+		return result
+
+	def pin_chat_message(self, chat_id, message_id, disable_notification=True):
+		result = self._request("pinChatMessage", {
+			'chat_id': chat_id,
+			'message_id': message_id,
+			'disable_notification': disable_notification})
+
+		# Check result and log errors
+		if 'ok' not in result or not result['ok']:
+			logger.error("Error while pinning message via Telegram API: %s", result.get('description', '-- unknown --'))
+		return result
+
+	def download_file(self, file_id, max_size=1024 * 1024):
+		"""
+		Download a file sent to the bot, e.g. a document.
+
+		:param max_size: Maximum size of the file (in bytes)
+		:return: The content of the file or None if it could not be downloaded or is too large
+		:rtype: bytes or None
+		"""
+		result = self._request("getFile", {'file_id': file_id})
+		if not result.get('ok') or 'file_path' not in result['result']:
+			logger.error("Error while getting file via Telegram API: %s", result.get('description', '-- unknown --'))
+			return None
+		if result['result'].get('file_size', 0) > max_size:
+			logger.warning("File %s is too large (%s bytes)", file_id, result['result']['file_size'])
+			return None
+		try:
+			response = self.session.get(self.FILE_URL.format(self.token, result['result']['file_path']),
+			                            timeout=(self.connect_timeout, self.read_timeout))
+			response.raise_for_status()
+		except Exception as e:
+			logger.error("Error while downloading file %s:", file_id, exc_info=e)
+			return None
+		return response.content
+
+	def answer_inline_query(self, inline_query_id, results, cache_time=300, is_personal=False):
+		result = self._request("answerInlineQuery", {
+			'inline_query_id': inline_query_id,
+			'results': results,
+			'cache_time': cache_time,
+			'is_personal': is_personal})
+
+		# Check result and log errors
+		if 'ok' not in result or not result['ok']:
+			logger.error("Error while answering inline query via Telegram API: %s",
+				result.get('description', '-- unknown --'))
+		return result
+
+	def set_webhook(self, webhook_url, secret_token=None, max_connections=None):
+		result = self._request("setWebhook", {
+			'url': webhook_url,
+			'secret_token': secret_token or None,
+			'max_connections': max_connections or None})
 
 		# Check result and log errors
 		if 'ok' not in result or not result['ok']:
-			logger.error("Error while deleting message via Telegram API: {}".format(
-				result['description'] if 'description' in result else '-- unknown --'))
+			logger.error("Error while setting webhook via Telegram API: %s", result.get('description', '-- unknown --'))
+		return result
+
+	def delete_webhook(self):
+		result = self._request("deleteWebhook")
+
+		# Check result and log errors
+		if 'ok' not in result or not result['ok']:
+			logger.error("Error while deleting webhook via Telegram API: %s",
+				result.get('description', '-- unknown --'))
+		return result
 
 	@staticmethod
 	def _get_last_update_id(updates):
 		return max(u['update_id'] for u in updates)
+
+
+def classify_error(result):
+	"""
+	Classify the result of a failed request by its error code, description and parameters. Results without an error
+	code (like the empty results of dropped requests) are considered transient.
+
+	:param result: The result of a request
+	:type result: dict
+	:return: One of the ERROR_* constants or None if the request was successful
+	:rtype: str or None
+	"""
+	if result.get('ok'):
+		return None
+	code = result.get('error_code')
+	if 'migrate_to_chat_id' in result.get('parameters', {}):
+		return ERROR_MIGRATED
+	if code == 429:
+		return ERROR_RATE_LIMITED
+	# 403 Forbidden: The bot was blocked by the user, kicked from the group, the user is deactivated, ...
+	if code == 403 or (code == 400 and _CHAT_GONE_PATTERN.search(result.get('description', ''))):
+		return ERROR_CHAT_GONE
+	if code is None or code >= 500:
+		return ERROR_TRANSIENT
+	return ERROR_INVALID
+
+
+def _decode_markup(reply_markup):
+	"""
+	Reply markups are passed as JSON strings (like in the form encoded API), but have to be embedded as objects into a
+	JSON request body.
+	"""
+	if isinstance(reply_markup, str):
+		return json.loads(reply_markup)
+	return reply_markup
+
+
+def _length(text):
+	"""
+	Length of a text as counted by Telegram (in UTF-16 code units)
+	"""
+	return len(text.encode('utf-16-le')) // 2
+
+
+def split_message(text, parse_mode="HTML", limit=MAX_MESSAGE_LENGTH):
+	"""
+	Split a message text with the given parse mode into parts not exceeding `limit` characters. See `split_html()`.
+
+	:rtype: [str]
+	"""
+	if parse_mode and parse_mode.upper() == "HTML":
+		return split_html(text, limit)
+	return split_text(text, limit)
+
+
+def split_text(text, limit=MAX_MESSAGE_LENGTH):
+	"""
+	Split a plain text into parts not exceeding `limit` characters. See `split_html()`.
+
+	:rtype: [str]
+	"""
+	return split_html(text, limit, html=False)
+
+
+def split_html(text, limit=MAX_MESSAGE_LENGTH, html=True):
+	"""
+	Split an HTML formatted message into few parts, each not exceeding `limit` characters. Parts end at the last
+	paragraph break (blank line) within the second half of the part, otherwise at the last line break or space, and
+	only as a last resort within a word. Texts are never split within an HTML tag or entity; tags which are open at
+	the split point are closed at the end of the part and opened again at the beginning of the next part.
+
+	:param text: The message text
+	:param limit: Maximum length of each part (in UTF-16 code units, like Telegram counts)
+	:param html: False to split a plain text, which may contain '<' and '&' as normal characters
+	:return: The parts of the message. A text within the limit is returned as single part.
+	:rtype: [str]
+	"""
+	if _length(text) <= limit:
+		return [text]
+
+	parts = []
+	# Length of the tags opened again at the beginning of the current part
+	reopened = 0
+	while _length(text) > limit:
+		tags = list(_TAG_PATTERN.finditer(text)) if html else []
+		forbidden = [(m.start() + 1, m.end()) for m in tags]
+		if html:
+			forbidden += [(m.start() + 1, m.end()) for m in _ENTITY_PATTERN.finditer(text)]
+
+		cut, open_tags = None, []
+		longest = _max_prefix(text, limit)
+		for separator in ('\n\n', '\n', ' ', ''):
+			# Don't split at a boundary if that wastes more than half of the part
+			lowest = max(reopened, longest // 2) if separator else reopened
+			position = longest
+			while position > lowest:
+				if separator:
+					position = text.rfind(separator, lowest, position)
+					if position <= lowest:
+						break
+				if not any(start <= position < end for start, end in forbidden):
+					open_tags = _open_tags(tags, position)
+					closing = ''.join('</{}>'.format(name) for name, _tag in reversed(open_tags))
+					if text[reopened:position].strip() and _length(text[:position]) + _length(closing) <= limit:
+						cut = position
+						break
+				position -= 1
+			if cut is not None:
+				break
+		if cut is None:
+			# The part consists of whitespace only: Cut anywhere outside of tags and entities, the part is dropped
+			for position in range(longest, reopened, -1):
+				if not any(start <= position < end for start, end in forbidden):
+					open_tags = _open_tags(tags, position)
+					closing = ''.join('</{}>'.format(name) for name, _tag in reversed(open_tags))
+					if _length(text[:position]) + _length(closing) <= limit:
+						cut = position
+						break
+		if cut is None:
+			# Only possible with tags longer than the limit: Cut within the tag rather than failing
+			cut = max(longest, reopened + 1)
+			open_tags = []
+
+		closing = ''.join('</{}>'.format(name) for name, _tag in reversed(open_tags))
+		if text[reopened:cut].strip():
+			parts.append(text[:cut].rstrip() + closing)
+		reopened = len(''.join(tag for _name, tag in open_tags))
+		text = ''.join(tag for _name, tag in open_tags) + text[cut:].lstrip()
+	if text.strip():
+		parts.append(text)
+	return parts
+
+
+def _max_prefix(text, limit):
+	"""
+	:return: The length of the longest prefix of the text, which does not exceed `limit` UTF-16 code units
+	"""
+	position = min(len(text), limit)
+	while _length(text[:position]) > limit:
+		position -= 1
+	return position
+
+
+def _open_tags(tags, position):
+	"""
+	:param tags: Matches of _TAG_PATTERN in a text
+	:return: (name, opening tag) of the tags which are open at the given position of the text
+	"""
+	stack = []
+	for m in tags:
+		if m.end() > position:
+			break
+		name = m.group(2).lower()
+		if not m.group(1):
+			stack.append((name, m.group(0)))
+		else:
+			for i in range(len(stack) - 1, -1, -1):
+				if stack[i][0] == name:
+					del stack[i]
+					break
+	return stack
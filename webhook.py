@@ -0,0 +1,95 @@
+import hmac
+import http.server
+import json
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    """
+    Minimal HTTP server to receive updates from Telegram via webhook. Each update POSTed to `path` is put into a
+    bounded queue, which is consumed by the bot's main loop with `get()`. If the queue is full, the request is rejected
+    with 503, so that Telegram delivers the update again later.
+
+    For local testing, recorded updates can be POSTed to the server, e.g.:
+        curl -H 'X-Telegram-Bot-Api-Secret-Token: <secret>' -d @update.json http://localhost:8443/telegram
+    """
+    SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+    def __init__(self, host='0.0.0.0', port=8443, path='/telegram', secret_token=None, max_queue=1000):
+        """
+        :param host: Address to listen on
+        :param port: Port to listen on
+        :param path: URL path to accept updates at
+        :param secret_token: If given, only requests with this value in the X-Telegram-Bot-Api-Secret-Token header
+                             are accepted
+        :param max_queue: Maximum number of received updates waiting to be processed
+        """
+        self.path = path
+        self.secret_token = secret_token
+        self.updates = queue.Queue(max_queue)
+        self.httpd = http.server.ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='webhook', daemon=True)
+        self._thread.start()
+        logger.info("Listening for webhook requests on port %s", self.port)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def get(self, timeout=None):
+        """
+        Get the next received update.
+
+        :param timeout: Maximum time to wait for an update (in seconds)
+        :return: The update or None if no update has been received within the timeout
+        :rtype: dict or None
+        """
+        try:
+            return self.updates.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    return self._respond(404)
+                if server.secret_token is not None and not hmac.compare_digest(
+                        self.headers.get(server.SECRET_HEADER, ''), server.secret_token):
+                    logger.warning("Rejected webhook request with invalid secret token from %s", self.client_address[0])
+                    return self._respond(403)
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    update = json.loads(self.rfile.read(length).decode('utf8'))
+                except ValueError:
+                    return self._respond(400)
+                try:
+                    server.updates.put_nowait(update)
+                except queue.Full:
+                    logger.warning("Webhook update queue is full. Rejecting update.")
+                    return self._respond(503)
+                self._respond(200)
+
+            def _respond(self, code):
+                self.send_response(code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug("Webhook request from %s: " + format, self.client_address[0], *args)
+
+        return Handler